@@ -18,23 +18,348 @@
 # along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
 
 from stream import *
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
+import hashlib
+import os
 import struct
+import tempfile
+import threading
+
+# Offset, size (low 16 bits), size (next 8 bits), flags, unknown
+fileTableRecord = struct.Struct('>LHBBH')
+
+# Tag, resource table offset, name table offset
+typeTableRecord = struct.Struct('>LHH')
+
+# Name offset used for resources without a name
+noName = 0xFFFFFFFF
+
+class ResourceTable:
+	# All resources of one type, as parallel columns sorted by ID
+	__slots__ = ('ids', 'offsets', 'sizes', 'nameOffsets')
+
+	def __init__(self):
+		self.ids = array('H')
+		self.offsets = array('I')
+		self.sizes = array('I')
+		self.nameOffsets = array('I')
+
+	def find(self, id):
+		# Returns the row for id, raising KeyError if it isn't present
+		row = bisect_left(self.ids, id)
+		if row == len(self.ids) or self.ids[row] != id:
+			raise KeyError(id)
+
+		return row
+
+	def keys(self):
+		return list(self.ids)
+
+	def memoryUsage(self):
+		return sum(column.itemsize * len(column) for column in (self.ids, self.offsets, self.sizes, self.nameOffsets))
+
+	def __contains__(self, id):
+		row = bisect_left(self.ids, id)
+		return row != len(self.ids) and self.ids[row] == id
+
+	def __len__(self):
+		return len(self.ids)
+
+class ResourceCache:
+	# Least-recently-used resource data, bounded by total size in bytes.
+	# It holds its own copies of the data, never views into a mapped file,
+	# so the budget counts memory the cache really uses and evicted or
+	# closed archives aren't kept open by it.
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._entries = OrderedDict()
+		self._size = 0
+
+	def get(self, key):
+		# Returns None on a miss
+		try:
+			data = self._entries.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+
+		# Re-insert to mark it as the most recently used
+		self._entries[key] = data
+		self.hits += 1
+		return data
+
+	def put(self, key, data):
+		# Anything bigger than the whole cache would just flush it
+		if len(data) > self.maxSize:
+			return
+
+		if key in self._entries:
+			self._size -= len(self._entries.pop(key))
+
+		self._entries[key] = data
+		self._size += len(data)
+
+		while self._size > self.maxSize:
+			oldKey, oldData = self._entries.popitem(last=False)
+			self._size -= len(oldData)
+			self.evictions += 1
+
+	def invalidate(self, key=None):
+		# Drop one entry, or everything if no key is given
+		if key is None:
+			self._entries.clear()
+			self._size = 0
+		elif key in self._entries:
+			self._size -= len(self._entries.pop(key))
+
+	def getStats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'entries': len(self._entries),
+			'size': self._size,
+			'maxSize': self.maxSize
+		}
+
+# Index cache header: magic, version, archive size, archive mtime, path length
+indexCacheHeader = struct.Struct('>4sHQdH')
+indexCacheVersion = 2
+
+def getIndexCachePath(cacheDir, path, extension='.idx'):
+	# One cache file per archive (and extension), named after its absolute path
+	absPath = os.path.abspath(path)
+	return os.path.join(cacheDir, hashlib.sha1(absPath).hexdigest() + extension)
+
+def getIndexCacheKey(path):
+	info = os.stat(path)
+	return (os.path.abspath(path), info.st_size, info.st_mtime)
+
+def loadIndexCache(cachePath, cacheKey):
+	# Returns the type map and name blob, or None if the cache doesn't
+	# match the archive
+	if not os.path.exists(cachePath):
+		return None
+
+	with open(cachePath, 'rb') as f:
+		stream = ByteStream(bytearray(f.read()))
+
+	magic, version, size, mtime, pathLength = stream.readStruct(indexCacheHeader)
+	if magic != 'MHKI' or version != indexCacheVersion:
+		return None
+
+	absPath = str(stream.read(pathLength))
+	if (absPath, size, mtime) != cacheKey:
+		return None
+
+	names = stream.read(stream.readUint32BE())
+
+	typeMap = {}
+	typeCount = stream.readUint16BE()
+
+	for i in range(typeCount):
+		tag = str(stream.read(stream.readByte()))
+		resCount = stream.readUint32BE()
+
+		table = ResourceTable()
+		table.ids = stream.readArray('H', resCount)
+		table.offsets = stream.readArray('I', resCount)
+		table.sizes = stream.readArray('I', resCount)
+		table.nameOffsets = stream.readArray('I', resCount)
+		typeMap[tag] = table
+
+	return typeMap, names
+
+def saveIndexCache(cachePath, cacheKey, typeMap, names):
+	absPath, size, mtime = cacheKey
+	output = ByteWriteStream()
+
+	output.write(indexCacheHeader.pack('MHKI', indexCacheVersion, size, mtime, len(absPath)))
+	output.write(absPath)
+	output.writeUint32BE(len(names))
+	output.write(names)
+	output.writeUint16BE(len(typeMap))
+
+	for tag, table in typeMap.items():
+		output.writeByte(len(tag))
+		output.write(tag)
+		output.writeUint32BE(len(table))
+		output.writeArray(table.ids)
+		output.writeArray(table.offsets)
+		output.writeArray(table.sizes)
+		output.writeArray(table.nameOffsets)
+
+	writeCacheFile(cachePath, output.getData())
+
+def writeCacheFile(cachePath, data):
+	# Write to a temporary file first so readers never see a partial cache
+	cacheDir = os.path.dirname(cachePath) or os.curdir
+	if not os.path.isdir(cacheDir):
+		os.makedirs(cacheDir)
+
+	handle, tempPath = tempfile.mkstemp(dir=cacheDir)
+	with os.fdopen(handle, 'wb') as f:
+		f.write(data)
+
+	try:
+		os.rename(tempPath, cachePath)
+	except OSError:
+		# Windows won't rename over an existing file
+		os.remove(cachePath)
+		os.rename(tempPath, cachePath)
 
-class FileTableEntry:
-	def __init__(self, offset, size, flags):
-		self.offset = offset
-		self.size = size
-		self.flags = flags
+class MohawkArchive:
+	def __init__(self, path, mapped=True, indexCacheDir=None, lazy=False, cacheSize=0):
+		self._path = path
+		self._mapped = mapped
+		self._stream = None
+
+		# Resources are read by offset, without touching the stream's
+		# position, so only the lazily parsed parts of the directory and
+		# the cache need guarding for concurrent readers. Reads in flight
+		# are counted so that close() can wait for them to finish.
+		self._lock = threading.RLock()
+		self._readers = 0
+		self._idle = threading.Condition(self._lock)
+
+		# A set of archives replaces this to track which files are open
+		self._beginRead = self._openForRead
+
+		stream = self._getStream()
+
+		# Optionally keep recently used resources around. The cached data
+		# is shared between callers, so it must not be modified.
+		# Unmapped reads are already copies; mapped ones are copied when
+		# they're cached.
+		if cacheSize > 0:
+			self._cache = ResourceCache(cacheSize)
+		else:
+			self._cache = None
+
+		# Try the index cache before parsing the directory ourselves
+		if indexCacheDir is not None:
+			cachePath = getIndexCachePath(indexCacheDir, path)
+			cacheKey = getIndexCacheKey(path)
+
+			try:
+				cache = loadIndexCache(cachePath, cacheKey)
+			except Exception:
+				# Damaged; rebuild it below
+				cache = None
+
+			if cache is not None:
+				self._typeMap, self._names = cache
+				self._fileOffsets = self._fileSizes = self._fileFlags = None
+				return
+
+		self._parseDirectory(stream)
+
+		# In lazy mode, each type's tables are parsed on first use instead.
+		# The cache needs everything, though.
+		if not lazy or indexCacheDir is not None:
+			for type in self._typeMap:
+				self._getResourceTable(type)
+
+		if indexCacheDir is not None:
+			try:
+				saveIndexCache(cachePath, cacheKey, self._typeMap, self._names)
+			except Exception:
+				# The cache is only an optimization
+				pass
+
+	def _getStream(self):
+		stream = self._stream
+
+		# (Re)open the file if needed
+		if stream is None:
+			with self._lock:
+				if self._stream is None:
+					# Map the file by default so that resources can be handed
+					# out as views into the file without copying
+					if self._mapped:
+						self._stream = MappedFileStream(open(self._path, 'rb'))
+					else:
+						self._stream = FileStream(open(self._path, 'rb'))
 
-class Resource:
-	def __init__(self, offset, size, name):
-		self.offset = offset
-		self.size = size
-		self.name = name
+				stream = self._stream
 
-class MohawkArchive:
-	def __init__(self, path):
-		stream = FileStream(open(path, 'rb'))
+		return stream
+
+	def _openForRead(self):
+		# Take a reader slot, so the file can't be closed out from under
+		# the read by another thread, and return the stream to read from
+		with self._lock:
+			stream = self._getStream()
+			self._readers += 1
+
+		return stream
+
+	def _endRead(self):
+		with self._lock:
+			self._readers -= 1
+			if self._readers == 0:
+				self._idle.notifyAll()
+
+	def _readAt(self, offset, size):
+		stream = self._beginRead()
+
+		try:
+			return stream.readAt(offset, size)
+		finally:
+			self._endRead()
+
+	def readAt(self, offset, size):
+		# Read from anywhere in the archive file, e.g. inside a resource
+		return self._readAt(offset, size)
+
+	def copyAt(self, offset, size, output):
+		# Copy part of the archive file to another open file. Each chunk
+		# gets its own reader slot, so a long copy doesn't hold off closing
+		# (or evicting) the archive for long.
+		while size > 0:
+			chunkSize = min(size, copyChunkSize)
+			stream = self._beginRead()
+
+			try:
+				stream.copyAt(offset, chunkSize, output)
+			finally:
+				self._endRead()
+
+			offset += chunkSize
+			size -= chunkSize
+
+	def close(self):
+		# The directory stays loaded; the file is reopened if it's needed again
+		with self._lock:
+			while self._readers > 0:
+				self._idle.wait()
+
+			if self._stream is not None:
+				self._stream.close()
+				self._stream = None
+
+	def _getDirectoryStream(self):
+		# The directory runs from absOffset to the end of the file. Reading
+		# it by offset keeps parsing safe alongside concurrent resource reads.
+		stream = self._beginRead()
+
+		try:
+			return ByteStream(stream.readAt(self._absOffset, stream.size() - self._absOffset))
+		finally:
+			self._endRead()
+
+	def getPath(self):
+		return self._path
+
+	def _parseDirectory(self, stream):
+		fileSize = stream.size()
+		stream = ByteStream(stream.readAt(0, 28))
 
 		mhkTag = stream.readUint32BE()
 		if mhkTag != makeTag('MHWK'):
@@ -56,96 +381,286 @@ class MohawkArchive:
 		fileTableOffset = stream.readUint16BE()
 		stream.readUint16BE() # File table size
 
+		self._absOffset = absOffset
+		self._fileSize = fileSize
+		stream = self._getDirectoryStream()
+
 		# Seek to the file table
-		stream.seek(absOffset + fileTableOffset)
+		stream.seek(fileTableOffset)
 		fileCount = stream.readUint32BE()
-		fileTable = []
+		fileOffsets = array('I')
+		fileSizes = array('I')
+		fileFlags = array('B')
 
 		# Read in each of the file table entries
-		for i in range(fileCount):
-			offset = stream.readUint32BE()
-			size = stream.readUint16BE()
-			size |= stream.readByte() << 16
-			flags = stream.readByte()
-			stream.readUint16BE() # Unknown
+		for offset, size, sizeHigh, flags, unknown in stream.readStructArray(fileTableRecord, fileCount):
+			size |= sizeHigh << 16
 			size |= (flags & 0x07) << 24 # Bottom 3 bits of flags are top 3 bits of file size
 
-			fileTable.append(FileTableEntry(offset, size, flags))
+			fileOffsets.append(offset)
+			fileSizes.append(size)
+			fileFlags.append(flags)
 
 		# Get to the type table
-		stream.seek(absOffset)
+		stream.seek(0)
 		stringTableOffset = stream.readUint16BE()
 		typeCount = stream.readUint16BE()
 
-		# Keep a set of all types
-		typeMap = {}
+		# Keep the location of each type's tables; the tables themselves
+		# are parsed by _getResourceTable()
+		typeTable = {}
+		for tag, resTableOffset, nameTableOffset in stream.readStructArray(typeTableRecord, typeCount):
+			typeTable[tagToString(tag).lstrip('\0')] = (tag, resTableOffset, nameTableOffset)
+
+		self._stringTableOffset = stringTableOffset
+		self._fileOffsets = fileOffsets
+		self._fileSizes = fileSizes
+		self._fileFlags = fileFlags
+		self._typeTable = typeTable
+		self._typeMap = dict.fromkeys(typeTable)
+
+		# All resource names, NUL-terminated, shared by every type
+		self._names = bytearray()
+
+	def _parseResourceTable(self, tag, resTableOffset, nameTableOffset):
+		stream = self._getDirectoryStream()
+		fileOffsets = self._fileOffsets
+		names = self._names
+
+		# Read in the name table for the type
+		stream.seek(nameTableOffset)
+		nameCount = stream.readUint16BE()
+		nameEntries = stream.readUint16BEArray(nameCount * 2)
+		nameTable = {}
+		internedNames = {}
+
+		for j in range(nameCount):
+			nameOffset = nameEntries[j * 2]
+			index = nameEntries[j * 2 + 1]
+
+			# Only store each string once
+			if nameOffset not in internedNames:
+				# Seek to the name
+				stream.seek(self._stringTableOffset + nameOffset)
+				internedNames[nameOffset] = len(names)
+				names.extend(stream.readCString())
+				names.append(0)
+
+			# Assign it to the table
+			nameTable[index] = internedNames[nameOffset]
+
+		# Read in the resource table for the type
+		stream.seek(resTableOffset)
+		resCount = stream.readUint16BE()
+		resEntries = stream.readUint16BEArray(resCount * 2)
+		rows = {}
+
+		for j in range(resCount):
+			resID = resEntries[j * 2]
+			index = resEntries[j * 2 + 1]
+
+			# Pull the name out of the name table
+			nameOffset = nameTable.get(index, noName)
+
+			# Get the file table entry
+			offset = fileOffsets[index - 1]
+
+			# Figure out the size
+			# tMOV is stored with the wrong size, so base it on offsets for that case
+			if tag == makeTag('tMOV'):
+				if index == len(fileOffsets):
+					size = self._fileSize - offset
+				else:
+					size = fileOffsets[index] - offset
+			else:
+				size = self._fileSizes[index - 1]
 
-		# Read each of the types
-		for i in range(typeCount):
-			resMap = {}
+			rows[resID] = (offset, size, nameOffset)
 
-			tag = stream.readUint32BE()
-			resTableOffset = stream.readUint16BE()
-			nameTableOffset = stream.readUint16BE()
+		# Store the rows sorted by ID so lookups can bisect
+		table = ResourceTable()
 
-			# Read in the name table for the type
-			stream.seek(absOffset + nameTableOffset)
-			nameCount = stream.readUint16BE()
-			nameTable = {}
-	
-			for j in range(nameCount):
-				nameOffset = stream.readUint16BE()
-				index = stream.readUint16BE()
-				oldPos = stream.tell()
+		for resID in sorted(rows):
+			offset, size, nameOffset = rows[resID]
+			table.ids.append(resID)
+			table.offsets.append(offset)
+			table.sizes.append(size)
+			table.nameOffsets.append(nameOffset)
 
-				# Seek to the name
-				stream.seek(absOffset + stringTableOffset + nameOffset)
-				name = stream.readCString()
-
-				# Assign it to the table
-				nameTable[index] = name
-
-				# Get back to the next entry
-				stream.seek(oldPos)
-
-			# Read in the resource table for the type
-			stream.seek(absOffset + resTableOffset)
-			resCount = stream.readUint16BE()
-
-			for j in range(resCount):
-				resID = stream.readUint16BE()
-				index = stream.readUint16BE()
-
-				# Pull the name out of the name table
-				try:
-					name = nameTable[index]
-				except KeyError:
-					name = None
-
-				# Get the file table entry
-				fileTableEntry = fileTable[index - 1]
-				offset = fileTableEntry.offset
-
-				# Figure out the size
-				# tMOV is stored with the wrong size, so base it on offsets for that case
-				if tag == makeTag('tMOV'):
-					if index == len(fileTable):
-						size = stream.size() - offset
-					else:
-						size = fileTable[index].offset - offset
-				else:
-					size = fileTableEntry.size
+		return table
 
-				resMap[resID] = Resource(offset, size, name)
+	def _getResourceTable(self, type):
+		# Raises KeyError for unknown types
+		table = self._typeMap[type]
 
-			typeMap[tagToString(tag).lstrip('\0')] = resMap
+		if table is None:
+			with self._lock:
+				# Another thread may have beaten us to it
+				table = self._typeMap[type]
 
-			# Seek to the next TypeTable entry
-			stream.seek(absOffset + (i + 1) * 8 + 4)
+				if table is None:
+					table = self._parseResourceTable(*self._typeTable[type])
+					self._typeMap[type] = table
 
-		# Store the type map
-		self._typeMap = typeMap
-		self._stream = stream
+		return table
+
+	def getTypes(self):
+		return self._typeMap.keys()
+
+	def hasResource(self, type, id):
+		try:
+			return id in self._getResourceTable(type)
+		except KeyError:
+			return False
+
+	def getResourceList(self, type):
+		return self._getResourceTable(type).keys()
+
+	def getResource(self, type, id):
+		if self._cache is not None:
+			with self._lock:
+				data = self._cache.get((type, id))
+
+			if data is not None:
+				return data
+
+		table = self._getResourceTable(type)
+		row = table.find(id)
+		data = self._readAt(table.offsets[row], table.sizes[row])
+
+		if self._cache is not None:
+			if not isinstance(data, bytearray):
+				data = bytearray(data)
+
+			with self._lock:
+				self._cache.put((type, id), data)
+
+		return data
+
+	def getCacheStats(self):
+		# Returns None if caching is disabled
+		if self._cache is None:
+			return None
+
+		with self._lock:
+			return self._cache.getStats()
+
+	def invalidateCache(self, type=None, id=None):
+		# Drop a single resource, or everything if none is given
+		if self._cache is None:
+			return
+
+		with self._lock:
+			if type is None:
+				self._cache.invalidate()
+			else:
+				self._cache.invalidate((type, id))
+
+	def getResourceOffset(self, type, id):
+		table = self._getResourceTable(type)
+		return table.offsets[table.find(id)]
+
+	def getResourceSize(self, type, id):
+		table = self._getResourceTable(type)
+		return table.sizes[table.find(id)]
+
+	def getResourceArchive(self, type, id):
+		# Matches MohawkArchiveSet; here it's always this archive
+		self._getResourceTable(type).find(id)
+		return self
+
+	def getName(self, type, id):
+		table = self._getResourceTable(type)
+		nameOffset = table.nameOffsets[table.find(id)]
+
+		if nameOffset == noName:
+			return None
+
+		return str(self._names[nameOffset:self._names.index('\0', nameOffset)])
+
+	def getIndexSize(self):
+		# Bytes used by the parsed directory, excluding Python object overhead
+		size = len(self._names)
+
+		if self._fileOffsets is not None:
+			for column in (self._fileOffsets, self._fileSizes, self._fileFlags):
+				size += column.itemsize * len(column)
+
+		for table in self._typeMap.values():
+			if table is not None:
+				size += table.memoryUsage()
+
+		return size
+
+def isMohawkArchive(path):
+	try:
+		with open(path, 'rb') as f:
+			return f.read(4) == 'MHWK'
+	except IOError:
+		return False
+
+class MohawkArchiveSet:
+	# Many archives (e.g. all of a game's stacks) searched as one. When
+	# several archives have the same resource, the first one listed wins;
+	# a directory's archives are taken in file name order.
+	def __init__(self, paths, maxOpen=16, **archiveOptions):
+		if isinstance(paths, basestring):
+			# Take every Mohawk file in the directory
+			directory = paths
+			paths = []
+
+			for fileName in sorted(os.listdir(directory), key=lambda x: x.lower()):
+				path = os.path.join(directory, fileName)
+				if os.path.isfile(path) and isMohawkArchive(path):
+					paths.append(path)
+
+		self._archives = []
+		self._maxOpen = max(maxOpen, 1)
+		self._lock = threading.Lock()
+		self._openArchives = OrderedDict()
+		self._typeMap = {}
+
+		for path in paths:
+			index = len(self._archives)
+			archive = MohawkArchive(path, **archiveOptions)
+			self._archives.append(archive)
+
+			# Every read from the archive, even through getResourceArchive,
+			# goes through the set from now on
+			archive._beginRead = partial(self._beginArchiveRead, index)
+
+			with self._lock:
+				self._useArchive(index)
+
+			# Merge its directory, keeping existing entries
+			for type in archive.getTypes():
+				resMap = self._typeMap.setdefault(type, {})
+
+				for id in archive.getResourceList(type):
+					resMap.setdefault(id, index)
+
+	def _useArchive(self, index):
+		# Track which archives have open files, closing the least
+		# recently used beyond the limit. The lock must be held.
+		if index in self._openArchives:
+			del self._openArchives[index]
+
+		self._openArchives[index] = self._archives[index]
+
+		while len(self._openArchives) > self._maxOpen:
+			oldIndex, oldArchive = self._openArchives.popitem(last=False)
+			oldArchive.close()
+
+	def _beginArchiveRead(self, index):
+		# Mark the archive as used and take its reader slot in one go, so
+		# that it can't be evicted in between and then reopened behind the
+		# set's back
+		with self._lock:
+			self._useArchive(index)
+			return self._archives[index]._openForRead()
+
+	def getArchives(self):
+		return list(self._archives)
 
 	def getTypes(self):
 		return self._typeMap.keys()
@@ -159,14 +674,32 @@ class MohawkArchive:
 	def getResourceList(self, type):
 		return self._typeMap[type].keys()
 
+	def getResourceArchive(self, type, id):
+		return self._archives[self._typeMap[type][id]]
+
 	def getResource(self, type, id):
-		resource = self._typeMap[type][id]
-		self._stream.seek(resource.offset)
-		return self._stream.read(resource.size)
+		return self.getResourceArchive(type, id).getResource(type, id)
 
 	def getResourceOffset(self, type, id):
-		return self._typeMap[type][id].offset
+		# The offset is within the archive the resource comes from
+		return self.getResourceArchive(type, id).getResourceOffset(type, id)
+
+	def getResourceSize(self, type, id):
+		return self.getResourceArchive(type, id).getResourceSize(type, id)
 
 	def getName(self, type, id):
-		return self._typeMap[type][id].name
+		return self.getResourceArchive(type, id).getName(type, id)
+
+	def close(self):
+		with self._lock:
+			for archive in self._openArchives.values():
+				archive.close()
+
+			self._openArchives.clear()
+
+def openArchive(path, **options):
+	# Directories are opened as a set of all the archives inside them
+	if os.path.isdir(path):
+		return MohawkArchiveSet(path, **options)
 
+	return MohawkArchive(path, **options)
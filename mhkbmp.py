@@ -18,9 +18,17 @@
 # along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
 
 from stream import *
-from mhkarch import MohawkArchive
+from mhkarch import openArchive
 import os
 import png
+import struct
+import threading
+
+# NumPy is optional; without it raw images are drawn a row at a time
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 # LZ decompression constants
 lzLengthBits = 6
@@ -30,29 +38,53 @@ lzMaxString = (1 << lzLengthBits) + lzMinString - 1
 lzBufferSize = 1 << lzPosBits
 lzPosMask = lzBufferSize - 1
 
+def copyLZString(outputData, dst, strPtr, stringLen):
+	# Equivalent to copying one byte at a time from strPtr to dst
+	distance = dst - strPtr
+
+	if strPtr < 0 or strPtr + stringLen > len(outputData):
+		# Odd pointers (negative ones index from the end of the buffer);
+		# leave those to the byte loop so they behave as they always have
+		for i in range(stringLen):
+			outputData[dst + i] = outputData[strPtr + i]
+	elif distance <= 0 or distance >= stringLen:
+		# No overlap with what's being written
+		outputData[dst:dst + stringLen] = outputData[strPtr:strPtr + stringLen]
+	else:
+		# Overlapping, so the string repeats every distance bytes
+		outputData[dst:dst + stringLen] = (outputData[strPtr:dst] * (stringLen // distance + 1))[:stringLen]
+
 def decompressLZ(stream, uncompressedSize):
 	flags = 0
 	bytesOut = 0
 	insertPos = 0
 
+	# Work on the compressed data directly rather than through the stream
+	start = stream.tell()
+	data = stream.read(stream.size() - start)
+	dataSize = len(data)
+	pos = 0
+
 	# Create a buffer for output
 	outBufSize = max(uncompressedSize, lzBufferSize)
-	outputData = bytearray([0 for x in range(outBufSize)])
+	outputData = bytearray(outBufSize)
 	dst = 0
 	buf = 0
 
-	while stream.tell() < stream.size():
+	while pos < dataSize:
 		flags >>= 1
 
 		if (flags & 0x100) == 0:
-			flags = stream.readByte() | 0xFF00
+			flags = data[pos] | 0xFF00
+			pos += 1
 
 		if (flags & 0x01) == 1:
 			bytesOut += 1
 			if bytesOut > uncompressedSize:
 				break
 
-			outputData[dst] = stream.readByte()
+			outputData[dst] = data[pos]
+			pos += 1
 			dst += 1
 
 			insertPos += 1
@@ -60,7 +92,8 @@ def decompressLZ(stream, uncompressedSize):
 				insertPos = 0
 				buf += lzBufferSize
 		else:
-			offLen = stream.readUint16BE()
+			offLen = (data[pos] << 8) | data[pos + 1]
+			pos += 2
 			stringLen = (offLen >> lzPosBits) + lzMinString
 			stringPos = (offLen + lzMaxString) & lzPosMask
 
@@ -73,6 +106,8 @@ def decompressLZ(stream, uncompressedSize):
 				if bytesOut >= lzBufferSize:
 					strPtr -= lzBufferSize
 				elif stringPos + stringLen > lzPosMask:
+					# Wraps around the start of the window; rare enough
+					# to keep as a byte loop
 					for i in range(stringLen):
 						outputData[dst] = outputData[strPtr]
 						dst += 1
@@ -95,16 +130,17 @@ def decompressLZ(stream, uncompressedSize):
 				insertPos &= lzPosMask
 				buf += lzBufferSize
 
-			for i in range(stringLen):
-				outputData[dst] = outputData[strPtr]
-				dst += 1
-				strPtr += 1
+			copyLZString(outputData, dst, strPtr, stringLen)
+			dst += stringLen
 
 			if bytesOut >= uncompressedSize:
 				break
 
-	# Slice out only the uncompressed data
-	return outputData[:uncompressedSize]
+	stream.seek(start + min(pos, dataSize))
+
+	# Trim down to only the uncompressed data
+	del outputData[uncompressedSize:]
+	return outputData
 
 def getBitsPerPixel(format):
 	try:
@@ -125,33 +161,64 @@ def drawRaw(stream, width, height, pitch, bitsPerPixel):
 	if bitsPerPixel not in (8, 24):
 		raise Exception('drawRaw only works on 8-bit and 24-bit images')
 
-	surface = []
+	if numpy is not None:
+		surface = drawRawSurface(stream, width, height, pitch, bitsPerPixel)
+		if surface is not None:
+			return (row for row in surface)
 
-	for y in range(height):
-		row = []
+	return drawRawRows(stream, width, height, pitch, bitsPerPixel)
 
-		if bitsPerPixel == 8:
-			row.extend(stream.read(width))
-			stream.seek(pitch - width, os.SEEK_CUR)
-		else:
-			for x in range(width):
-				b = stream.readByte()
-				g = stream.readByte()
-				r = stream.readByte()
-				row.extend([r, g, b])
+def drawRawSurface(stream, width, height, pitch, bitsPerPixel):
+	# Returns a (height, width * bytesPerPixel) array over one copy of the
+	# pixel data, or None to leave the image to drawRawRows
+	rowSize = width * bitsPerPixel // 8
+	if height == 0 or pitch == 0 or pitch < rowSize:
+		return None
 
-			stream.seek(pitch - width * 3, os.SEEK_CUR)
+	start = stream.tell()
+	data = stream.read(pitch * height)
 
-		surface.append(row)
+	# The last row doesn't need its padding; anything shorter than that
+	# is left to the plain path to fail on
+	if len(data) < pitch * (height - 1) + rowSize:
+		stream.seek(start)
+		return None
+
+	if len(data) < pitch * height:
+		data += bytearray(pitch * height - len(data))
+
+	surface = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, pitch)[:, :rowSize]
+
+	if bitsPerPixel == 24:
+		# Stored as BGR; swap the red and blue channels of the whole image
+		# in place, so that every row is still a plain view
+		pixels = surface.reshape(height, width, 3)
+		blue = pixels[:, :, 0].copy()
+		pixels[:, :, 0] = pixels[:, :, 2]
+		pixels[:, :, 2] = blue
 
 	return surface
 
+def drawRawRows(stream, width, height, pitch, bitsPerPixel):
+	rowSize = width * bitsPerPixel // 8
+
+	for y in range(height):
+		row = stream.read(rowSize)
+
+		if bitsPerPixel == 24:
+			# Stored as BGR; swap the red and blue bytes
+			row[0::3], row[2::3] = row[2::3], row[0::3]
+
+		stream.seek(pitch - rowSize, os.SEEK_CUR)
+		yield row
+
 def drawRLE8(stream, width, height, pitch, bitsPerPixel, isLE=False):
 	if bitsPerPixel != 8:
 		raise Exception('drawRLE8 only works on 8-bit images')
 
-	surface = []
+	return drawRLE8Rows(stream, width, height, isLE)
 
+def drawRLE8Rows(stream, width, height, isLE):
 	for y in range(height):
 		if isLE:
 			rowByteCount = stream.readUint16LE()
@@ -160,7 +227,7 @@ def drawRLE8(stream, width, height, pitch, bitsPerPixel, isLE=False):
 
 		startPos = stream.tell()
 		remaining = width
-		row = []
+		row = bytearray()
 
 		while remaining > 0:
 			code = stream.readByte()
@@ -170,17 +237,123 @@ def drawRLE8(stream, width, height, pitch, bitsPerPixel, isLE=False):
 				runLen = remaining
 
 			if (code & 0x80) == 0:
-				row.extend(stream.read(runLen))
+				row += stream.read(runLen)
 			else:
 				val = stream.readByte()
-				row.extend([val] * runLen)
+				row += bytearray([val]) * runLen
 
 			remaining -= runLen
 
-		surface.append(row)
 		stream.seek(startPos + rowByteCount)
+		yield row
 
-	return surface
+def applyPalette(surface, palette):
+	# Expand 8-bit rows into RGB rows, one row at a time, with one
+	# translation table per channel, then interleave them
+	tables = [bytes(bytearray(color[channel] for color in palette)) for channel in range(3)]
+
+	for row in surface:
+		# NumPy rows (from drawRawSurface) have no translate
+		if not isinstance(row, bytearray):
+			row = bytearray(row)
+
+		rgbRow = bytearray(len(row) * 3)
+
+		for channel in range(3):
+			rgbRow[channel::3] = row.translate(tables[channel])
+
+		yield rgbRow
+
+# zlib levels for each PNG profile
+# The PNG writer only emits unfiltered rows, so the level is all there
+# is to choose
+pngProfiles = {
+	'none': 0,
+	'fast': 1,
+	'balanced': 6,
+	'max': 9
+}
+
+def getPNGCompression(options):
+	profile = options.get('pngProfile') or 'max'
+
+	try:
+		return pngProfiles[profile]
+	except KeyError:
+		raise Exception('Unknown PNG profile: {0}'.format(profile))
+
+def writePNG(output, width, height, palette, surface, options):
+	# The surface is consumed one row at a time
+	writer = png.Writer(width, height, bitdepth=8, greyscale=False, palette=palette, compression=getPNGCompression(options))
+	writer.write(output, surface)
+
+def writePPM(output, width, height, palette, surface, options):
+	if palette is not None:
+		surface = applyPalette(surface, palette)
+
+	output.write('P6\n{0} {1}\n255\n'.format(width, height))
+
+	for row in surface:
+		output.write(row)
+
+def writePGM(output, width, height, palette, surface, options):
+	# The palette indices are written as grey levels
+	if palette is None:
+		raise Exception('PGM output only works on 8-bit images')
+
+	output.write('P5\n{0} {1}\n255\n'.format(width, height))
+
+	for row in surface:
+		output.write(row)
+
+def writeNPY(output, width, height, palette, surface, options):
+	# Always RGB, so every image loads the same way
+	if palette is not None:
+		surface = applyPalette(surface, palette)
+
+	header = "{{'descr': '|u1', 'fortran_order': False, 'shape': ({0}, {1}, 3), }}".format(height, width)
+
+	# Pad the header (plus its newline) so the data is 16-byte aligned
+	header += ' ' * (15 - (len(header) + 10) % 16) + '\n'
+
+	output.write('\x93NUMPY\x01\x00')
+	output.write(struct.pack('<H', len(header)))
+	output.write(header)
+
+	for row in surface:
+		output.write(row)
+
+# All image writers, indexed by file extension
+imageWriters = {
+	'npy': writeNPY,
+	'pgm': writePGM,
+	'png': writePNG,
+	'ppm': writePPM
+}
+
+def writeSurfaceFile(baseName, width, height, palette, surface, options):
+	imageFormat = options.get('imageFormat') or 'png'
+
+	try:
+		writeFunc = imageWriters[imageFormat]
+	except KeyError:
+		raise Exception('Unknown image format: {0}'.format(imageFormat))
+
+	# Catch a bad profile before creating the file
+	if imageFormat == 'png':
+		getPNGCompression(options)
+
+	fileName = '{0}.{1}'.format(baseName, imageFormat)
+	f = open(fileName, 'wb')
+
+	# Rows are decoded as they're written, so don't leave half an image
+	# behind if decoding fails part way through
+	try:
+		with f:
+			writeFunc(f, width, height, palette, surface, options)
+	except:
+		os.remove(fileName)
+		raise
 
 # All drawing functions
 drawFuncs = {
@@ -201,185 +374,235 @@ def unpackLZ(stream):
 
 	return decompressLZ(stream, uncompressedSize)
 
+def copyRivenRun(output, distance, length):
+	# Equivalent to appending output[-distance] length times, but in bulk
+	start = len(output) - distance
+
+	if distance <= 0 or start < 0:
+		# Degenerate distances; do exactly what the byte loop would do
+		for i in range(length):
+			output.append(output[-distance])
+	elif distance >= length:
+		output += output[start:start + length]
+	else:
+		# Overlapping, so the run repeats every distance bytes
+		output += (output[start:] * (length // distance + 1))[:length]
+
+# Riven sub-command handlers
+# Each takes the output, the packed data, the current position in the
+# packed data and the sub-command, and returns the new position.
+
+def rivenRepeatWord(output, data, pos, subCode):
+	output.append(output[-(subCode * 2)])
+	output.append(output[-(subCode * 2)])
+	return pos
+
+def rivenWordThenByte(output, data, pos, subCode):
+	output.append(output[-2])
+	output.append(data[pos])
+	return pos + 1
+
+def rivenWordThenCopy(output, data, pos, subCode):
+	output.append(output[-2])
+	output.append(output[-(subCode & 0x0F)])
+	return pos
+
+def rivenWordThenAdd(output, data, pos, subCode):
+	output.append(output[-2])
+	output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+	return pos
+
+def rivenWordThenSubtract(output, data, pos, subCode):
+	output.append(output[-2])
+	output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+	return pos
+
+def rivenByteThenWord(output, data, pos, subCode):
+	output.append(data[pos])
+	output.append(output[-2])
+	return pos + 1
+
+def rivenCopyThenWord(output, data, pos, subCode):
+	output.append(output[-(subCode & 0x0F)])
+	output.append(output[-2])
+	return pos
+
+def rivenTwoBytes(output, data, pos, subCode):
+	output += data[pos:pos + 2]
+	return pos + 2
+
+def rivenCopyThenByte(output, data, pos, subCode):
+	output.append(output[-(subCode & 0x07)])
+	output.append(data[pos])
+	return pos + 1
+
+def rivenByteThenCopy(output, data, pos, subCode):
+	output.append(data[pos])
+	output.append(output[-(subCode & 0x07)])
+	return pos + 1
+
+def rivenByteThenAdd(output, data, pos, subCode):
+	output.append(data[pos])
+	output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+	return pos + 1
+
+def rivenByteThenSubtract(output, data, pos, subCode):
+	output.append(data[pos])
+	output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+	return pos + 1
+
+def rivenAddThenWord(output, data, pos, subCode):
+	output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+	output.append(output[-2])
+	return pos
+
+def rivenAddThenByte(output, data, pos, subCode):
+	output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+	output.append(data[pos])
+	return pos + 1
+
+def rivenSubtractThenWord(output, data, pos, subCode):
+	output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+	output.append(output[-2])
+	return pos
+
+def rivenSubtractThenByte(output, data, pos, subCode):
+	output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+	output.append(data[pos])
+	return pos + 1
+
+def rivenPattern(addHigh, addLow):
+	# Both bytes are offsets from the previous word, packed as nibbles
+	def handler(output, data, pos, subCode):
+		pattern = data[pos]
+
+		if addHigh:
+			output.append((output[-2] + (pattern >> 4)) & 0xFF)
+		else:
+			output.append((output[-2] - (pattern >> 4)) & 0xFF)
+
+		if addLow:
+			output.append((output[-2] + (pattern & 0x0F)) & 0xFF)
+		else:
+			output.append((output[-2] - (pattern & 0x0F)) & 0xFF)
+
+		return pos + 1
+
+	return handler
+
+def rivenRun(length, hasByte):
+	# Back reference with a 10-bit distance, optionally followed by a literal
+	def handler(output, data, pos, subCode):
+		distance = ((subCode & 0x03) << 8) | data[pos]
+		copyRivenRun(output, distance, length)
+
+		if hasByte:
+			output.append(data[pos + 1])
+			return pos + 2
+
+		return pos + 1
+
+	return handler
+
+def rivenLongRun(output, data, pos, subCode):
+	code1 = data[pos]
+	code2 = data[pos + 1]
+	distance = ((code1 & 0x03) << 8) | code2
+	length = ((code1 >> 3) + 1) * 2 + 1
+	copyRivenRun(output, distance, length)
+
+	if (code1 & (1 << 2)) == 0:
+		output.append(data[pos + 2])
+		return pos + 3
+
+	output.append(output[-distance])
+	return pos + 2
+
+def rivenUnknown(output, data, pos, subCode):
+	raise Exception('Unknown Riven pack subcode 0x{0:02X}'.format(subCode))
+
+def buildRivenSubCommands():
+	table = [rivenUnknown] * 256
+
+	def assign(first, last, handler):
+		for subCode in range(first, last + 1):
+			table[subCode] = handler
+
+	assign(0x01, 0x0F, rivenRepeatWord)
+	assign(0x10, 0x10, rivenWordThenByte)
+	assign(0x11, 0x1F, rivenWordThenCopy)
+	assign(0x20, 0x2F, rivenWordThenAdd)
+	assign(0x30, 0x3F, rivenWordThenSubtract)
+	assign(0x40, 0x40, rivenByteThenWord)
+	assign(0x41, 0x4F, rivenCopyThenWord)
+	assign(0x50, 0x50, rivenTwoBytes)
+	assign(0x51, 0x57, rivenCopyThenByte)
+	assign(0x59, 0x5F, rivenByteThenCopy)
+	assign(0x60, 0x6F, rivenByteThenAdd)
+	assign(0x70, 0x7F, rivenByteThenSubtract)
+	assign(0x80, 0x8F, rivenAddThenWord)
+	assign(0x90, 0x9F, rivenAddThenByte)
+	assign(0xA0, 0xA0, rivenPattern(True, True))
+	assign(0xA4, 0xA7, rivenRun(3, True))
+	assign(0xA8, 0xAB, rivenRun(4, False))
+	assign(0xAC, 0xAF, rivenRun(5, True))
+	assign(0xB0, 0xB0, rivenPattern(True, False))
+	assign(0xB4, 0xB7, rivenRun(6, False))
+	assign(0xB8, 0xBB, rivenRun(7, True))
+	assign(0xBC, 0xBF, rivenRun(8, False))
+	assign(0xC0, 0xCF, rivenSubtractThenWord)
+	assign(0xD0, 0xDF, rivenSubtractThenByte)
+	assign(0xE0, 0xE0, rivenPattern(False, True))
+	assign(0xE4, 0xE7, rivenRun(9, True))
+	assign(0xE8, 0xEB, rivenRun(10, False))
+	assign(0xEC, 0xEF, rivenRun(11, True))
+	assign(0xF0, 0xF0, rivenPattern(False, False))
+	assign(0xF4, 0xF7, rivenRun(12, False))
+	assign(0xF8, 0xFB, rivenRun(13, True))
+	assign(0xFC, 0xFC, rivenLongRun)
+	assign(0xFF, 0xFF, rivenPattern(False, False))
+
+	return table
+
+# Sub-command handlers, indexed by sub-command
+rivenSubCommands = buildRivenSubCommands()
+
 def unpackRiven(stream):
 	stream.readUint32BE() # Skip buffer size
 
-	output = bytearray()
+	# Work on the packed data directly rather than through the stream
+	start = stream.tell()
+	data = stream.read(stream.size() - start)
+	dataSize = len(data)
+	pos = 0
 
-	subCommands = []
+	output = bytearray()
+	subCommands = rivenSubCommands
 
-	while stream.tell() < stream.size():
-		code = stream.readByte()
+	while pos < dataSize:
+		code = data[pos]
+		pos += 1
 
 		if code == 0x00:
 			# End of data
 			break
-		elif code in range(0x01, 0x40):
+		elif code < 0x40:
 			# Word Verbatim
-			output.extend(stream.read(code * 2))
-		elif code in range(0x40, 0x80):
+			output += data[pos:pos + code * 2]
+			pos += code * 2
+		elif code < 0x80:
 			# Word Repeat
-			data = output[-2:]
-
-			for i in range(code - 0x40):
-				output.extend(data)
-		elif code in range(0x80, 0xC0):
+			output += output[-2:] * (code - 0x40)
+		elif code < 0xC0:
 			# Double Word Repeat
-			data = output[-4:]
-
-			for i in range(code - 0x80):
-				output.extend(data)
+			output += output[-4:] * (code - 0x80)
 		else:
 			# Specialized Commands
 			for i in range(code - 0xC0):
-				subCode = stream.readByte()
-
-				if subCode in range(0x01, 0x10):
-					output.append(output[-(subCode * 2)])
-					output.append(output[-(subCode * 2)])
-				elif subCode == 0x10:
-					output.append(output[-2])
-					output.append(stream.readByte())
-				elif subCode in range(0x11, 0x20):
-					output.append(output[-2])
-					output.append(output[-(subCode & 0x0F)])
-				elif subCode in range(0x20, 0x30):
-					output.append(output[-2])
-					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
-				elif subCode in range(0x30, 0x40):
-					output.append(output[-2])
-					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
-				elif subCode == 0x40:
-					output.append(stream.readByte())
-					output.append(output[-2])
-				elif subCode in range(0x41, 0x50):
-					output.append(output[-(subCode & 0x0F)])
-					output.append(output[-2])
-				elif subCode == 0x50:
-					output.extend(stream.read(2))
-				elif subCode in range(0x51, 0x58):
-					output.append(output[-(subCode & 0x07)])
-					output.append(stream.readByte())
-				elif subCode in range(0x59, 0x60):
-					output.append(stream.readByte())
-					output.append(output[-(subCode & 0x07)])
-				elif subCode in range(0x60, 0x70):
-					output.append(stream.readByte())
-					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
-				elif subCode in range(0x70, 0x80):
-					output.append(stream.readByte())
-					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
-				elif subCode in range(0x80, 0x90):
-					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
-					output.append(output[-2])
-				elif subCode in range(0x90, 0xA0):
-					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
-					output.append(stream.readByte())
-				elif subCode == 0xA0:
-					pattern = stream.readByte()
-					output.append((output[-2] + (pattern >> 4)) & 0xFF)
-					output.append((output[-2] + (pattern & 0x0F)) & 0xFF)
-				elif subCode in range(0xA4, 0xA8):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(3):
-						output.append(output[-distance])
-
-					output.append(stream.readByte())
-				elif subCode in range(0xA8, 0xAC):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(4):
-						output.append(output[-distance])
-				elif subCode in range(0xAC, 0xB0):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(5):
-						output.append(output[-distance])
-
-					output.append(stream.readByte())
-				elif subCode == 0xB0:
-					pattern = stream.readByte()
-					output.append((output[-2] + (pattern >> 4)) & 0xFF)
-					output.append((output[-2] - (pattern & 0x0F)) & 0xFF)
-				elif subCode in range(0xB4, 0xB8):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(6):
-						output.append(output[-distance])
-				elif subCode in range(0xB8, 0xBC):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(7):
-						output.append(output[-distance])
-
-					output.append(stream.readByte())
-				elif subCode in range(0xBC, 0xC0):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(8):
-						output.append(output[-distance])
-				elif subCode in range(0xC0, 0xD0):
-					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
-					output.append(output[-2])
-				elif subCode in range(0xD0, 0xE0):
-					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
-					output.append(stream.readByte())
-				elif subCode == 0xE0:
-					pattern = stream.readByte()
-					output.append((output[-2] - (pattern >> 4)) & 0xFF)
-					output.append((output[-2] + (pattern & 0x0F)) & 0xFF)
-				elif subCode in range(0xE4, 0xE8):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(9):
-						output.append(output[-distance])
-
-					output.append(stream.readByte())
-				elif subCode in range(0xE8, 0xEC):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(10):
-						output.append(output[-distance])
-				elif subCode in range(0xEC, 0xF0):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(11):
-						output.append(output[-distance])
-
-					output.append(stream.readByte())
-				elif subCode in (0xF0, 0xFF):
-					pattern = stream.readByte()
-					output.append((output[-2] - (pattern >> 4)) & 0xFF)
-					output.append((output[-2] - (pattern & 0x0F)) & 0xFF)
-				elif subCode in range(0xF4, 0xF8):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(12):
-						output.append(output[-distance])
-				elif subCode in range(0xF8, 0xFC):
-					distance = ((subCode & 0x03) << 8) | stream.readByte()
-
-					for j in range(13):
-						output.append(output[-distance])
-
-					output.append(stream.readByte())
-				elif subCode == 0xFC:
-					code1 = stream.readByte()
-					code2 = stream.readByte()
-					distance = ((code1 & 0x03) << 8) | code2
-					length = ((code1 >> 3) + 1) * 2 + 1
-
-					for j in range(length):
-						output.append(output[-distance])
-
-					if (code1 & (1 << 2)) == 0:
-						output.append(stream.readByte())
-					else:
-						output.append(output[-distance])
-				else:
-					raise Exception('Unknown Riven pack subcode 0x{0:02X}'.format(subCode))
+				subCode = data[pos]
+				pos = subCommands[subCode](output, data, pos + 1, subCode)
 
+	stream.seek(start + min(pos, dataSize))
 	return output
 
 # All unpackers
@@ -426,6 +649,61 @@ def findPalette(archive, resID):
 	else:
 		raise Exception('Failed to find palette with ID {0}'.format(resID))
 
+class PaletteProvider:
+	# Opens each palette archive once and decodes each palette once
+	def __init__(self):
+		self._archives = {}
+		self._palettes = {}
+		self._lock = threading.Lock()
+
+	def getArchive(self, path):
+		with self._lock:
+			try:
+				return self._archives[path]
+			except KeyError:
+				# This may also be a directory of archives
+				archive = openArchive(path, lazy=True)
+				self._archives[path] = archive
+				return archive
+
+	def getPalette(self, archive, resID):
+		key = (archive, resID)
+
+		with self._lock:
+			try:
+				return self._palettes[key]
+			except KeyError:
+				palette = findPalette(archive, resID)
+				self._palettes[key] = palette
+				return palette
+
+	def close(self):
+		with self._lock:
+			for archive in self._archives.values():
+				archive.close()
+
+			self._archives = {}
+			self._palettes = {}
+
+def getPaletteProvider(options):
+	# Callers share one provider per run through the options; otherwise
+	# the palette is looked up afresh and nothing outlives the image
+	provider = options.get('paletteProvider')
+	if provider is None:
+		provider = PaletteProvider()
+
+	return provider
+
+def sharePaletteProvider(options):
+	# Returns the options with a palette provider in them, so that every
+	# image in a resource shares it, and the provider to close afterwards
+	# if one had to be created here
+	if options.get('paletteProvider') is not None:
+		return options, None
+
+	provider = PaletteProvider()
+	return dict(options, paletteProvider=provider), provider
+
 def isValidOffsetSet(offsets, streamSize):
 	# The offset needs to be after the set of the offsets
 	minOffset = len(offsets) * 4 + 8
@@ -468,23 +746,6 @@ def decodeImage(stream, archive, resType, resID, options):
 	else:
 		palette = None
 
-	# We need a palette if we're less than 16-bit color
-	if bitsPerPixel < 16 and not palette:
-		# See if we have the option set
-		paletteID = options['palette']
-		if paletteID is None:
-			raise Exception('{0} {1} has no palette; please specify one'.format(resType, resID))
-
-		# See if the palette file override is set
-		paletteFile = options['paletteFile']
-		if paletteFile is None:
-			palArchive = archive
-		else:
-			palArchive = MohawkArchive(paletteFile)
-
-		# Decode the palette
-		palette = findPalette(palArchive, paletteID)
-
 	# Figure out the unpacker
 	try:
 		unpackFunc = unpackFuncs[packType]
@@ -496,16 +757,36 @@ def decodeImage(stream, archive, resType, resID, options):
 
 	# Attempt to detect if this is really a set of images
 	if packType != PackType.Riven and drawType == DrawType.Raw and stream.size() > width * 4:
-		offsets = [stream.readUint32BE() for i in range(width)]
+		offsets = stream.readUint32BEArray(width)
 
-		# Return a set of None
+		# Convert the set straight from what we've unpacked, then return a
+		# set of None
 		if isValidOffsetSet(offsets, stream.size()):
-			convertMohawkBitmapSet(archive, resType, resID, options)
+			stream.seek(0)
+			convertMohawkBitmapSetData(stream, width, archive, resType, resID, options)
 			return None, None, None, None
 
 		# Seek back and continue decompression
 		stream.seek(0)
 
+	# We need a palette if we're less than 16-bit color
+	if bitsPerPixel < 16 and not palette:
+		# See if we have the option set
+		paletteID = options['palette']
+		if paletteID is None:
+			raise Exception('{0} {1} has no palette; please specify one'.format(resType, resID))
+
+		# See if the palette file override is set
+		paletteProvider = getPaletteProvider(options)
+		paletteFile = options['paletteFile']
+		if paletteFile is None:
+			palArchive = archive
+		else:
+			palArchive = paletteProvider.getArchive(paletteFile)
+
+		# Decode the palette
+		palette = paletteProvider.getPalette(palArchive, paletteID)
+
 	# Figure out the drawing function
 	try:
 		drawFunc = drawFuncs[drawType]
@@ -521,18 +802,22 @@ def convertMohawkBitmap(archive, resType, resID, options):
 
 	stream = ByteStream(resource)
 
-	# Decode the image
-	width, height, palette, surface = decodeImage(stream, archive, resType, resID, options)
+	# This may turn out to be a whole set of images
+	options, paletteProvider = sharePaletteProvider(options)
+
+	try:
+		# Decode the image
+		width, height, palette, surface = decodeImage(stream, archive, resType, resID, options)
 
-	# Bail if the surface is None
-	if surface is None:
-		return
+		# Bail if the surface is None
+		if surface is None:
+			return
 
-	# Write to a file
-	f = open('{0}_{1}.png'.format(resType, resID), 'wb')
-	with f:
-		writer = png.Writer(width, height, bitdepth=8, palette=palette, compression=9)
-		writer.write(f, surface)
+		# Write to a file, decoding as we go
+		writeSurfaceFile('{0}_{1}'.format(resType, resID), width, height, palette, surface, options)
+	finally:
+		if paletteProvider is not None:
+			paletteProvider.close()
 
 def convertMohawkBitmapSet(archive, resType, resID, options):
 	# Get the resource from the file
@@ -552,12 +837,20 @@ def convertMohawkBitmapSet(archive, resType, resID, options):
 	except KeyError:
 		raise Exception('Unknown pack type {0}'.format(packType))
 
-	# Decode the offsets
-	stream = ByteStream(unpackFunc(stream))
-	offsets = [stream.readUint32BE() - 8 for i in range(imageCount)]
+	# Decode the images, looking up the palette only once
+	options, paletteProvider = sharePaletteProvider(options)
+
+	try:
+		convertMohawkBitmapSetData(ByteStream(unpackFunc(stream)), imageCount, archive, resType, resID, options)
+	finally:
+		if paletteProvider is not None:
+			paletteProvider.close()
+
+def convertMohawkBitmapSetData(stream, imageCount, archive, resType, resID, options):
+	# The stream holds the unpacked set, starting with the offsets
+	offsets = [offset - 8 for offset in stream.readUint32BEArray(imageCount)]
 
-	# Decode all the surfaces
-	surfaces = []
+	# Decode and write one image at a time
 	for i in range(imageCount):
 		stream.seek(offsets[i])
 
@@ -570,17 +863,10 @@ def convertMohawkBitmapSet(archive, resType, resID, options):
 		# Read in the subimage
 		subStream = ByteStream(stream.read(length))
 
-		# Decode that image
-		surfaces.append(decodeImage(subStream, archive, resType, resID, options))
-
-	# Write the images to files
-	for i in range(imageCount):
-		width, height, palette, surface = surfaces[i]
-
-		f = open('{0}_{1}_{2}.png'.format(resType, resID, i), 'wb')
-		with f:
-			writer = png.Writer(width, height, bitdepth=8, palette=palette, compression=9)
-			writer.write(f, surface)
+		# Decode that image, writing it out as it's drawn
+		width, height, palette, surface = decodeImage(subStream, archive, resType, resID, options)
+		if surface is not None:
+			writeSurfaceFile('{0}_{1}_{2}'.format(resType, resID, i), width, height, palette, surface, options)
 
 def convertMystBitmap(archive, resType, resID, options):
 	# Get the resource from the file
@@ -19,43 +19,75 @@
 
 from stream import *
 import os
+import struct
 
-def copyAtomToFile(stream, output, resOffset):
-	# Read and copy the atom size/tag
-	atomSize = stream.readUint32BE()
-	atomTag = stream.read(4)
-	output.writeUint32BE(atomSize)
-	output.write(atomTag)
-
-	if atomTag in ('moov', 'trak', 'mdia', 'minf', 'stbl'):
-		# These atoms contain leaves that may contain 'stco'
-		copyAtomToFile(stream, output, resOffset)
-	elif atomTag == 'stco':
+# Atoms that contain leaves that may contain 'stco' or 'co64'
+containerAtoms = ('moov', 'trak', 'mdia', 'minf', 'stbl')
+
+def copyAtomToFile(source, output, pos, end, resOffset):
+	# Copy the atom at pos in the archive file, returning where the next
+	# one starts. Containers only have their header copied, as their
+	# children follow straight after it and get copied in turn.
+	atomSize, atomTag = struct.unpack('>L4s', source.readAt(pos, 8))
+	headerSize = 8
+
+	if atomSize == 1:
+		# 64-bit size, following the tag
+		atomSize = struct.unpack('>Q', source.readAt(pos + 8, 8))[0]
+		headerSize = 16
+	elif atomSize == 0:
+		# Runs to the end of the movie
+		atomSize = end - pos
+
+	if atomSize < headerSize:
+		raise Exception('Invalid size for the {0} atom: {1}'.format(atomTag, atomSize))
+
+	# Don't run past the end of the movie
+	atomSize = min(atomSize, end - pos)
+
+	output.write(source.readAt(pos, headerSize))
+
+	if atomTag in containerAtoms:
+		return pos + headerSize
+
+	if atomTag in ('stco', 'co64'):
 		# This atom needs to be rewritten
-		output.write(stream.read(4)) # Version, flags
-		chunkCount = stream.readUint32BE()
-		output.writeUint32BE(chunkCount)
-
-		for i in range(chunkCount):
-			chunkOffset = stream.readUint32BE()
-			newChunkOffset = chunkOffset - resOffset
-			output.writeUint32BE(newChunkOffset)
+		atom = ByteStream(source.readAt(pos + headerSize, atomSize - headerSize))
+		outStream = FileWriteStream(output)
+
+		outStream.write(atom.read(4)) # Version, flags
+		chunkCount = atom.readUint32BE()
+		outStream.writeUint32BE(chunkCount)
+
+		if atomTag == 'stco':
+			chunkOffsets = atom.readUint32BEArray(chunkCount)
+			outStream.writeUint32BEArray([chunkOffset - resOffset for chunkOffset in chunkOffsets])
+		else:
+			chunkOffsets = struct.unpack('>{0}Q'.format(chunkCount), atom.read(chunkCount * 8))
+			outStream.write(struct.pack('>{0}Q'.format(chunkCount), *[chunkOffset - resOffset for chunkOffset in chunkOffsets]))
+
+		# Keep anything trailing the table
+		outStream.write(atom.read(atom.size() - atom.tell()))
 	else:
-		# Copy verbatim
-		output.write(stream.read(atomSize - 8))
+		# Copy verbatim, file to file
+		source.copyAt(pos + headerSize, atomSize - headerSize, output)
 
-def convertQuickTimeMovie(archive, resType, resID, options):
-	# Get the resource from the file
-	resource = archive.getResource(resType, resID)
-	stream = ByteStream(resource)
+	return pos + atomSize
 
-	# Get the offset, as we need to convert all internal offsets
+def convertQuickTimeMovie(archive, resType, resID, options):
+	# Find the movie in its archive file; it's copied from there directly,
+	# through the archive's own (possibly pooled) file, rather than being
+	# loaded into memory
+	source = archive.getResourceArchive(resType, resID)
 	resOffset = archive.getResourceOffset(resType, resID)
+	resSize = archive.getResourceSize(resType, resID)
 
-	# Parse and write to the file
+	# We need to convert all internal offsets, as they're relative to the
+	# archive rather than the movie. Parse and write to the file.
 	output = open('{0}_{1}.mov'.format(resType, resID), 'wb')
 	with output:
-		outStream = FileWriteStream(output)
+		pos = resOffset
+		end = resOffset + resSize
 
-		while stream.tell() < stream.size():
-			copyAtomToFile(stream, outStream, resOffset)
+		while pos < end:
+			pos = copyAtomToFile(source, output, pos, end, resOffset)
@@ -18,12 +18,18 @@
 # along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
 
 from stream import *
+from mhkarch import MohawkArchive, getIndexCacheKey, getIndexCachePath, openArchive, writeCacheFile
 import json
+import multiprocessing
+import os
+import struct
+import threading
+import weakref
 
 def parseRivenNameList(stream):
 	# Read the header
 	nameCount = stream.readUint16BE()
-	stringOffsets = [stream.readUint16BE() for i in range(nameCount)]
+	stringOffsets = stream.readUint16BEArray(nameCount)
 	# (There are another nameCount set of uint16s here, but their meaning is unknown)
 	strings = []
 
@@ -36,6 +42,64 @@ def parseRivenNameList(stream):
 
 	return strings
 
+# The NAME resources used by scripts
+class RivenNameID:
+	Card = 1
+	Hotspot = 2
+	ExternalCommand = 3
+	Variable = 4
+	Stack = 5
+
+class RivenNameTables:
+	# Parses each of an archive's NAME resources once, when first needed
+	def __init__(self, archive):
+		# Only a weak reference, so that these (kept per archive below)
+		# don't keep the archive itself alive
+		self._archive = weakref.ref(archive)
+		self._nameLists = {}
+		self._lock = threading.Lock()
+
+	def getNames(self, resID):
+		with self._lock:
+			try:
+				return self._nameLists[resID]
+			except KeyError:
+				archive = self._archive()
+				if archive is None:
+					raise Exception('The archive for these names has gone away')
+
+				names = parseRivenNameList(ByteStream(archive.getResource('NAME', resID)))
+				self._nameLists[resID] = names
+				return names
+
+	def getCardNames(self):
+		return self.getNames(RivenNameID.Card)
+
+	def getHotspotNames(self):
+		return self.getNames(RivenNameID.Hotspot)
+
+	def getExternalCommandNames(self):
+		return self.getNames(RivenNameID.ExternalCommand)
+
+	def getVariableNames(self):
+		return self.getNames(RivenNameID.Variable)
+
+	def getStackNames(self):
+		return self.getNames(RivenNameID.Stack)
+
+# Name tables for each open archive, shared by every conversion
+rivenNameTables = weakref.WeakKeyDictionary()
+rivenNameTablesLock = threading.Lock()
+
+def getRivenNameTables(archive):
+	with rivenNameTablesLock:
+		try:
+			return rivenNameTables[archive]
+		except KeyError:
+			tables = RivenNameTables(archive)
+			rivenNameTables[archive] = tables
+			return tables
+
 def convertRivenNames(archive, resType, resID, options):
 	# Get the resource from the file
 	resource = archive.getResource(resType, resID)
@@ -103,164 +167,739 @@ scriptTypeNames = {
 	10: 'Card Update'
 }
 
-def decodeRivenCommands(stream, externalCommandNames, variableNames, stackNames, tabs=0):
-	text = ''
+class RivenCommand:
+	# A single script command, with its arguments as read. switch commands
+	# also have their cases, as (value, commands) pairs where the default
+	# case has a value of None.
+	__slots__ = ('opcode', 'args', 'cases')
+
+	def __init__(self, opcode, args, cases=None):
+		self.opcode = opcode
+		self.args = args
+		self.cases = cases
+
+class RivenCard:
+	__slots__ = ('nameID', 'isZipModeDest', 'scripts')
+
+	def __init__(self, nameID, isZipModeDest, scripts):
+		self.nameID = nameID
+		self.isZipModeDest = isZipModeDest
+		self.scripts = scripts
+
+class RivenHotspot:
+	__slots__ = ('blstID', 'nameID', 'left', 'top', 'right', 'bottom', 'cursor', 'index', 'zipModeHotspot', 'scripts')
+
+	def __init__(self, blstID, nameID, left, top, right, bottom, cursor, index, zipModeHotspot, scripts):
+		self.blstID = blstID
+		self.nameID = nameID
+		self.left = left
+		self.top = top
+		self.right = right
+		self.bottom = bottom
+		self.cursor = cursor
+		self.index = index
+		self.zipModeHotspot = zipModeHotspot
+		self.scripts = scripts
+
+def parseRivenCommands(stream):
+	commands = []
 	commandCount = stream.readUint16BE()
 
 	for i in range(commandCount):
 		command = stream.readUint16BE()
 		varCount = stream.readUint16BE()
-		text += '\t' * tabs
+		cases = None
 
-		if command == 7:
-			# Assign Variable
-			varIndex = stream.readUint16BE()
-			immediateValue = stream.readUint16BE()
-			text += '{0} = {1};\n'.format(variableNames[varIndex], immediateValue)
+		if command == 7 or command == 24:
+			# Assign Variable/Add to Variable: the variable and the value
+			args = stream.readUint16BEArray(2)
 		elif command == 8:
-			# Switch Statement
-			varIndex = stream.readUint16BE()
+			# Switch Statement: the variable, then each case's script
+			args = [stream.readUint16BE()]
 			caseCount = stream.readUint16BE()
+			cases = []
 
-			text += 'switch ({0}) {{\n'.format(variableNames[varIndex])
-
-			for i in range(caseCount):
-				text += '\t' * tabs
+			for j in range(caseCount):
 				caseImmediate = stream.readUint16BE()
 
-				# Write the case
 				if caseImmediate == 0xFFFF:
-					text += 'default:\n'
-				else:
-					text += 'case {0}:\n'.format(caseImmediate)
-
-				# Decode the case's script
-				text += decodeRivenCommands(stream, externalCommandNames, variableNames, stackNames, tabs + 1)
+					caseImmediate = None
 
-				# Add a break
-				text += '\t' * (tabs + 1) + 'break;\n'
-
-			text += '\t' * tabs + '}\n'
+				cases.append((caseImmediate, parseRivenCommands(stream)))
 		elif command == 17:
-			# External Command
+			# External Command: the name, then its own variables
 			nameIndex = stream.readUint16BE()
 			exVarCount = stream.readUint16BE()
-			variables = [str(stream.readUint16BE()) for i in range(exVarCount)]
-			text += externalCommandNames[nameIndex] + '(' + ', '.join(variables) + ');\n'
-		elif command == 24:
-			# Add to Variable
-			varIndex = stream.readUint16BE()
-			immediateValue = stream.readUint16BE()
-			text += '{0} += {1};\n'.format(variableNames[varIndex], immediateValue)
+			args = [nameIndex] + stream.readUint16BEArray(exVarCount)
 		elif command == 27:
-			# Change Stack
+			# Change Stack: the stack and the RMAP code
 			stackIndex = stream.readUint16BE()
 			rmapCode = stream.readUint32BE()
-			text += 'changeStack({0}, {1});\n'.format(stackNames[stackIndex], rmapCode)
+			args = [stackIndex, rmapCode]
 		else:
 			# Default
-			variables = [str(stream.readUint16BE()) for i in range(varCount)]
-			text += opcodeNames[command] + '(' + ', '.join(variables) + ');\n'
+			args = stream.readUint16BEArray(varCount)
+
+		commands.append(RivenCommand(command, args, cases))
 
-	return text
+	return commands
 
-def decodeRivenScript(stream, externalCommandNames, variableNames, stackNames, tabs=0):
-	text = ''
+def parseRivenScripts(stream):
+	# A list of (script type, commands) pairs
+	scripts = []
 	scriptCount = stream.readUint16BE()
 
 	for i in range(scriptCount):
-		if text:
-			text += '\n'
+		scriptType = stream.readUint16BE()
+		scripts.append((scriptType, parseRivenCommands(stream)))
 
-		text += '\t' * tabs + '{0} Script:\n'.format(scriptTypeNames[stream.readUint16BE()])
-		text += decodeRivenCommands(stream, externalCommandNames, variableNames, stackNames, tabs + 1)
+	return scripts
 
-	return text
+def parseRivenCard(stream):
+	nameID = stream.readUint16BE()
+	isZipModeDest = stream.readUint16BE()
+	return RivenCard(nameID, isZipModeDest, parseRivenScripts(stream))
 
-def convertRivenCard(archive, resType, resID, options):
-	# Get the resource from the file
-	resource = archive.getResource(resType, resID)
+def parseRivenHotspots(stream):
+	hotspots = []
+	hotspotCount = stream.readUint16BE()
 
-	stream = ByteStream(resource)
+	for i in range(hotspotCount):
+		blstID = stream.readUint16BE()
+		nameID = stream.readUint16BE()
+		left = stream.readSint16BE()
+		top = stream.readSint16BE()
+		right = stream.readSint16BE()
+		bottom = stream.readSint16BE()
+		stream.readUint16BE() # Unknown
+		cursor = stream.readUint16BE()
+		index = stream.readUint16BE()
+		stream.readUint16BE() # Unknown
+		zipModeHotspot = stream.readUint16BE()
+		scripts = parseRivenScripts(stream)
 
-	# Get the external command and variable name lists
-	cardNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 1)))
-	externalCommandNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 3)))
-	variableNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 4)))
-	stackNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 5)))
+		hotspots.append(RivenHotspot(blstID, nameID, left, top, right, bottom, cursor, index, zipModeHotspot, scripts))
 
-	# Parse the resource
-	nameID = stream.readUint16BE()
-	isZipModeDest = stream.readUint16BE()
+	return hotspots
+
+# Text emitters
+# These hand each piece of text to write (such as a list's append or a
+# file's write) rather than building strings up, so nesting costs nothing.
+
+def writeRivenCommands(write, commands, nameTables, tabs=0):
+	externalCommandNames = nameTables.getExternalCommandNames()
+	variableNames = nameTables.getVariableNames()
+	stackNames = nameTables.getStackNames()
+	indent = '\t' * tabs
+
+	for command in commands:
+		opcode = command.opcode
+		args = command.args
+
+		if opcode == 7:
+			write('{0}{1} = {2};\n'.format(indent, variableNames[args[0]], args[1]))
+		elif opcode == 8:
+			write('{0}switch ({1}) {{\n'.format(indent, variableNames[args[0]]))
+
+			for caseImmediate, caseCommands in command.cases:
+				# Write the case
+				if caseImmediate is None:
+					write(indent + 'default:\n')
+				else:
+					write('{0}case {1}:\n'.format(indent, caseImmediate))
+
+				# Write the case's script
+				writeRivenCommands(write, caseCommands, nameTables, tabs + 1)
+
+				# Add a break
+				write(indent + '\tbreak;\n')
+
+			write(indent + '}\n')
+		elif opcode == 17:
+			write(indent + externalCommandNames[args[0]] + '(' + ', '.join(str(arg) for arg in args[1:]) + ');\n')
+		elif opcode == 24:
+			write('{0}{1} += {2};\n'.format(indent, variableNames[args[0]], args[1]))
+		elif opcode == 27:
+			write('{0}changeStack({1}, {2});\n'.format(indent, stackNames[args[0]], args[1]))
+		else:
+			write(indent + opcodeNames[opcode] + '(' + ', '.join(str(arg) for arg in args) + ');\n')
+
+def writeRivenScripts(write, scripts, nameTables, tabs=0):
+	for i, (scriptType, commands) in enumerate(scripts):
+		if i != 0:
+			write('\n')
 
+		write('\t' * tabs + '{0} Script:\n'.format(scriptTypeNames[scriptType]))
+		writeRivenCommands(write, commands, nameTables, tabs + 1)
+
+def writeRivenCard(write, card, nameTables):
 	# See if we actually have a name
-	if nameID == 0xFFFF:
+	if card.nameID == 0xFFFF:
 		nameText = '<No Card Name>'
 	else:
-		nameText = cardNames[nameID]
+		nameText = nameTables.getCardNames()[card.nameID]
 
 	# Create a header with some basic info
-	text = 'Card Name: {0}\nIs Zip Mode Destination? {1}\n\n'.format(nameText, 'Yes' if isZipModeDest else 'No')
+	write('Card Name: {0}\nIs Zip Mode Destination? {1}\n\n'.format(nameText, 'Yes' if card.isZipModeDest else 'No'))
+
+	# Add in the script
+	writeRivenScripts(write, card.scripts, nameTables)
 
-	# Add in the decoded script
-	text += decodeRivenScript(stream, externalCommandNames, variableNames, stackNames)
+def writeRivenHotspots(write, hotspots, nameTables):
+	# Have some canned text for a hotspot-less card
+	if not hotspots:
+		write('No Hotspots!\n')
+		return
+
+	for hotspot in hotspots:
+		# See if we actually have a name
+		if hotspot.nameID == 0xFFFF:
+			nameText = '<No Card Name>'
+		else:
+			nameText = nameTables.getHotspotNames()[hotspot.nameID]
+
+		# Add a nice header
+		write('Hotspot {0}: {1}\n'.format(hotspot.index, nameText))
+		write('\tRect: {0}, {1}, {2}, {3}\n'.format(hotspot.left, hotspot.top, hotspot.right, hotspot.bottom))
+		write('\tCursor: {0}\n'.format(hotspot.cursor))
+		write('\tIs Zip Mode Hotspot? {0}\n'.format('Yes' if hotspot.zipModeHotspot else 'No'))
+		write('\tBLST ID: {0}\n\n'.format(hotspot.blstID))
+
+		# Now actually add the script
+		writeRivenScripts(write, hotspot.scripts, nameTables, 1)
+		write('\n')
+
+# JSON emitters
+# These turn the parsed tree into plain lists and dicts, with the names
+# filled in, ready for the JSON encoder.
+
+def rivenCommandsToJSON(commands, nameTables):
+	externalCommandNames = nameTables.getExternalCommandNames()
+	variableNames = nameTables.getVariableNames()
+	stackNames = nameTables.getStackNames()
+	result = []
+
+	for command in commands:
+		opcode = command.opcode
+		args = command.args
+
+		if opcode == 7 or opcode == 24:
+			entry = {'variable': variableNames[args[0]], 'value': args[1]}
+		elif opcode == 8:
+			cases = []
+
+			for caseImmediate, caseCommands in command.cases:
+				cases.append({'value': caseImmediate, 'commands': rivenCommandsToJSON(caseCommands, nameTables)})
+
+			entry = {'variable': variableNames[args[0]], 'cases': cases}
+		elif opcode == 17:
+			entry = {'command': externalCommandNames[args[0]], 'args': args[1:]}
+		elif opcode == 27:
+			entry = {'stack': stackNames[args[0]], 'code': args[1]}
+		else:
+			entry = {'args': list(args)}
+
+		entry['opcode'] = opcodeNames[opcode]
+		result.append(entry)
+
+	return result
+
+def rivenScriptsToJSON(scripts, nameTables):
+	return [{'type': scriptTypeNames[scriptType], 'commands': rivenCommandsToJSON(commands, nameTables)} for scriptType, commands in scripts]
+
+def rivenCardToJSON(card, nameTables):
+	return {
+		'name': None if card.nameID == 0xFFFF else nameTables.getCardNames()[card.nameID],
+		'zipModeDestination': bool(card.isZipModeDest),
+		'scripts': rivenScriptsToJSON(card.scripts, nameTables)
+	}
+
+def rivenHotspotsToJSON(hotspots, nameTables):
+	result = []
+
+	for hotspot in hotspots:
+		result.append({
+			'index': hotspot.index,
+			'name': None if hotspot.nameID == 0xFFFF else nameTables.getHotspotNames()[hotspot.nameID],
+			'rect': [hotspot.left, hotspot.top, hotspot.right, hotspot.bottom],
+			'cursor': hotspot.cursor,
+			'zipMode': bool(hotspot.zipModeHotspot),
+			'blstID': hotspot.blstID,
+			'scripts': rivenScriptsToJSON(hotspot.scripts, nameTables)
+		})
+
+	return result
+
+def writeRivenOutput(resType, resID, options, tree, nameTables, writeText, toJSON):
+	# Emit everything first, so that a bad name doesn't leave a partial file
+	if options.get('scriptFormat') == 'json':
+		# The text needs to be ASCII
+		pieces = list(json.JSONEncoder(encoding='ascii', sort_keys=True).iterencode(toJSON(tree, nameTables)))
+		fileName = '{0}_{1}.json'.format(resType, resID)
+	else:
+		pieces = []
+		writeText(pieces.append, tree, nameTables)
+		fileName = '{0}_{1}.txt'.format(resType, resID)
 
 	# Write to a file
-	output = open('{0}_{1}.txt'.format(resType, resID), 'wb')
+	output = open(fileName, 'wb')
 	with output:
-		output.write(text)
+		output.write(''.join(pieces))
 
-def convertRivenHotspots(archive, resType, resID, options):
+def convertRivenCard(archive, resType, resID, options):
 	# Get the resource from the file
 	resource = archive.getResource(resType, resID)
 
-	stream = ByteStream(resource)
+	# Parse the resource
+	card = parseRivenCard(ByteStream(resource))
+
+	# Write it out, with the names from the archive
+	writeRivenOutput(resType, resID, options, card, getRivenNameTables(archive), writeRivenCard, rivenCardToJSON)
 
-	# Get the external command and variable name lists
-	hotspotNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 2)))
-	externalCommandNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 3)))
-	variableNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 4)))
-	stackNames = parseRivenNameList(ByteStream(archive.getResource('NAME', 5)))
+def convertRivenHotspots(archive, resType, resID, options):
+	# Get the resource from the file
+	resource = archive.getResource(resType, resID)
 
 	# Parse the hotspots
-	hotspotCount = stream.readUint16BE()
-	text = ''
+	hotspots = parseRivenHotspots(ByteStream(resource))
+
+	# Write them out, with the names from the archive
+	writeRivenOutput(resType, resID, options, hotspots, getRivenNameTables(archive), writeRivenHotspots, rivenHotspotsToJSON)
+
+# Script index
+# Maps what scripts use (opcodes, variables, external commands and stacks)
+# back to the cards and hotspots using them, across any number of archives.
+
+rivenScriptIndexVersion = 1
+
+# How many resources each index job decodes
+rivenIndexJobSize = 32
+
+def collectRivenCommandKeys(commands, nameTables, keys):
+	externalCommandNames = nameTables.getExternalCommandNames()
+	variableNames = nameTables.getVariableNames()
+	stackNames = nameTables.getStackNames()
+
+	for command in commands:
+		opcode = command.opcode
+		args = command.args
+		keys.add(('opcode', opcodeNames.get(opcode, str(opcode))))
+
+		if opcode == 7 or opcode == 24:
+			keys.add(('variable', variableNames[args[0]]))
+			keys.add(('write', variableNames[args[0]]))
+		elif opcode == 8:
+			keys.add(('variable', variableNames[args[0]]))
+			keys.add(('read', variableNames[args[0]]))
+
+			for caseImmediate, caseCommands in command.cases:
+				collectRivenCommandKeys(caseCommands, nameTables, keys)
+		elif opcode == 17:
+			keys.add(('command', externalCommandNames[args[0]]))
+		elif opcode == 27:
+			keys.add(('stack', stackNames[args[0]]))
+
+def collectRivenScriptKeys(scripts, nameTables):
+	keys = set()
+
+	for scriptType, commands in scripts:
+		collectRivenCommandKeys(commands, nameTables, keys)
+
+	return sorted(keys)
+
+# Archives opened by this process's index jobs
+rivenIndexArchives = {}
+
+def indexRivenScriptsWorker(job):
+	# Returns the path, each (type, ID, hotspot index, keys) entry and any
+	# per-resource errors
+	path, resType, resIDs = job
+
+	try:
+		archive = rivenIndexArchives[path]
+	except KeyError:
+		archive = openArchive(path, lazy=True)
+		rivenIndexArchives[path] = archive
+
+	nameTables = getRivenNameTables(archive)
+	entries = []
+	errors = []
+
+	for resID in resIDs:
+		try:
+			stream = ByteStream(archive.getResource(resType, resID))
+
+			if resType == 'CARD':
+				card = parseRivenCard(stream)
+				entries.append((resType, resID, None, collectRivenScriptKeys(card.scripts, nameTables)))
+			else:
+				for hotspot in parseRivenHotspots(stream):
+					entries.append((resType, resID, hotspot.index, collectRivenScriptKeys(hotspot.scripts, nameTables)))
+		except Exception as ex:
+			errors.append((resType, resID, str(ex)))
+
+	return path, entries, errors
+
+class RivenScriptIndex:
+	def __init__(self, files, locations, keys, errors=None):
+		# files: a list of (path, size, mtime)
+		# locations: a list of (file index, type, ID, hotspot index or None)
+		# keys: kind -> name -> list of location indices
+		self._files = files
+		self._locations = locations
+		self._keys = keys
+		self._errors = errors or []
+
+	def __len__(self):
+		return len(self._locations)
+
+	def getFiles(self):
+		return [file[0] for file in self._files]
+
+	def getErrors(self):
+		# The (path, type, ID, error) of each script that failed to index;
+		# these aren't saved
+		return self._errors
+
+	def isStale(self):
+		# True if any indexed archive has changed since
+		for path, size, mtime in self._files:
+			try:
+				if getIndexCacheKey(path) != (path, size, mtime):
+					return True
+			except OSError:
+				return True
+
+		return False
+
+	def getKinds(self):
+		return sorted(self._keys)
+
+	def getNames(self, kind):
+		return sorted(self._keys.get(kind, {}))
+
+	def _getLocation(self, index):
+		fileIndex, resType, resID, hotspotIndex = self._locations[index]
+		return self._files[fileIndex][0], resType, resID, hotspotIndex
+
+	def find(self, kind, name):
+		# Every (path, type, ID, hotspot index) using name as kind
+		return [self._getLocation(index) for index in self._keys.get(kind, {}).get(name, [])]
+
+	def query(self, terms):
+		# The locations matching all of the (kind, name) terms
+		matches = None
+
+		for kind, name in terms:
+			locations = set(self._keys.get(kind, {}).get(name, []))
+			matches = locations if matches is None else matches & locations
+
+		return [self._getLocation(index) for index in sorted(matches or [])]
+
+	def save(self, path):
+		data = {
+			'version': rivenScriptIndexVersion,
+			'files': self._files,
+			'locations': self._locations,
+			'keys': self._keys
+		}
+
+		# Never leave half an index behind
+		writeCacheFile(path, json.dumps(data, sort_keys=True))
+
+def loadRivenScriptIndex(path):
+	f = open(path, 'rb')
+	with f:
+		data = json.load(f)
+
+	if data.get('version') != rivenScriptIndexVersion:
+		raise Exception('Unsupported script index version in \'{0}\''.format(path))
+
+	# JSON turns tuples into lists and strings into unicode
+	files = [(str(filePath), size, mtime) for filePath, size, mtime in data['files']]
+	locations = [(fileIndex, str(resType), resID, hotspotIndex) for fileIndex, resType, resID, hotspotIndex in data['locations']]
+	keys = dict((str(kind), dict((str(name), indices) for name, indices in names.items())) for kind, names in data['keys'].items())
+
+	return RivenScriptIndex(files, locations, keys)
+
+def buildRivenScriptIndex(paths, jobCount=1):
+	# Directories are indexed as each of the archives inside them
+	archivePaths = []
+
+	for path in paths:
+		archive = openArchive(path, lazy=True)
+
+		if os.path.isdir(path):
+			archives = archive.getArchives()
+		else:
+			archives = [archive]
 
-	for i in range(hotspotCount):
-		blstID = stream.readUint16BE()
-		nameID = stream.readUint16BE()
-		left = stream.readSint16BE()
-		top = stream.readSint16BE()
-		right = stream.readSint16BE()
-		bottom = stream.readSint16BE()
-		u0 = stream.readUint16BE()
-		cursor = stream.readUint16BE()
-		index = stream.readUint16BE()
-		u1 = stream.readUint16BE()
-		zipModeHotspot = stream.readUint16BE()
+		for subArchive in archives:
+			archivePath = os.path.abspath(subArchive.getPath())
+			if archivePath not in archivePaths:
+				archivePaths.append(archivePath)
 
-		# See if we actually have a name
-		if nameID == 0xFFFF:
-			nameText = '<No Card Name>'
-		else:
-			nameText = hotspotNames[nameID]
+		archive.close()
 
-		# Add a nice header
-		text += 'Hotspot {0}: {1}\n'.format(index, nameText)
-		text += '\tRect: {0}, {1}, {2}, {3}\n'.format(left, top, right, bottom)
-		text += '\tCursor: {0}\n'.format(cursor)
-		text += '\tIs Zip Mode Hotspot? {0}\n'.format('Yes' if zipModeHotspot else 'No')
-		text += '\tBLST ID: {0}\n\n'.format(blstID)
+	# Split the scripts up into jobs
+	jobs = []
+	files = []
 
-		# Now actually add the script
-		text += decodeRivenScript(stream, externalCommandNames, variableNames, stackNames, 1)
-		text += '\n'
+	for archivePath in archivePaths:
+		files.append(getIndexCacheKey(archivePath))
+		archive = openArchive(archivePath)
 
-	# Have some canned text for a hotspot-less card
-	if not text:
-		text = 'No Hotspots!\n'
+		for resType in ('CARD', 'HSPT'):
+			if resType not in archive.getTypes():
+				continue
 
-	# Write to a file
-	output = open('{0}_{1}.txt'.format(resType, resID), 'wb')
-	with output:
-		output.write(text)
+			resIDs = sorted(archive.getResourceList(resType))
+
+			for i in range(0, len(resIDs), rivenIndexJobSize):
+				jobs.append((archivePath, resType, resIDs[i:i + rivenIndexJobSize]))
+
+		archive.close()
+
+	if jobCount > 1:
+		pool = multiprocessing.Pool(jobCount)
+		results = pool.imap(indexRivenScriptsWorker, jobs)
+	else:
+		pool = None
+		results = (indexRivenScriptsWorker(job) for job in jobs)
+
+	# Merge everything into the one index
+	fileIndices = dict((files[i][0], i) for i in range(len(files)))
+	locations = []
+	keys = {}
+	errors = []
+
+	for path, entries, jobErrors in results:
+		fileIndex = fileIndices[path]
+
+		for resType, resID, hotspotIndex, entryKeys in entries:
+			locationIndex = len(locations)
+			locations.append((fileIndex, resType, resID, hotspotIndex))
+
+			for kind, name in entryKeys:
+				keys.setdefault(kind, {}).setdefault(name, []).append(locationIndex)
+
+		errors.extend((path, resType, resID, error) for resType, resID, error in jobErrors)
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+	else:
+		for archive in rivenIndexArchives.values():
+			archive.close()
+
+		rivenIndexArchives.clear()
+
+	return RivenScriptIndex(files, locations, keys, errors)
+
+# Hotspot index
+# Every card's hotspot rects, bucketed into a coarse grid over the screen
+# so that point and rect lookups only check the hotspots nearby. Anything
+# off the screen lands in the edge cells.
+
+hotspotGridCellSize = 32
+hotspotGridColumns = 20
+hotspotGridRows = 15
+
+# Hotspot index cache: magic, version, archive size, archive mtime, path length
+hotspotCacheHeader = struct.Struct('>4sHQdH')
+hotspotCacheVersion = 1
+
+# index, left, top, right, bottom, BLST ID, name ID, cursor, zip mode
+hotspotCacheRecord = struct.Struct('>HhhhhHHHH')
+
+def getHotspotGridCells(left, top, right, bottom):
+	# The cells touched by a non-empty rect
+	firstColumn = max(0, min(left // hotspotGridCellSize, hotspotGridColumns - 1))
+	lastColumn = max(0, min((right - 1) // hotspotGridCellSize, hotspotGridColumns - 1))
+	firstRow = max(0, min(top // hotspotGridCellSize, hotspotGridRows - 1))
+	lastRow = max(0, min((bottom - 1) // hotspotGridCellSize, hotspotGridRows - 1))
+
+	for row in range(firstRow, lastRow + 1):
+		for column in range(firstColumn, lastColumn + 1):
+			yield row * hotspotGridColumns + column
+
+class RivenCardHotspots:
+	# One card's hotspots, and which of them touch each grid cell
+	__slots__ = ('hotspots', '_grid')
+
+	def __init__(self, hotspots):
+		self.hotspots = hotspots
+		self._grid = {}
+
+		for i, hotspot in enumerate(hotspots):
+			# Empty rects can't contain anything
+			if hotspot.right <= hotspot.left or hotspot.bottom <= hotspot.top:
+				continue
+
+			for cell in getHotspotGridCells(hotspot.left, hotspot.top, hotspot.right, hotspot.bottom):
+				self._grid.setdefault(cell, []).append(i)
+
+	def findPoint(self, x, y):
+		# Like the engine, the right and bottom edges are exclusive
+		result = []
+
+		for cell in getHotspotGridCells(x, y, x + 1, y + 1):
+			for i in self._grid.get(cell, ()):
+				hotspot = self.hotspots[i]
+				if hotspot.left <= x < hotspot.right and hotspot.top <= y < hotspot.bottom:
+					result.append(hotspot)
+
+		return result
+
+	def findRect(self, left, top, right, bottom):
+		if right <= left or bottom <= top:
+			return []
+
+		candidates = set()
+		for cell in getHotspotGridCells(left, top, right, bottom):
+			candidates.update(self._grid.get(cell, ()))
+
+		result = []
+
+		for i in sorted(candidates):
+			hotspot = self.hotspots[i]
+			if hotspot.left < right and left < hotspot.right and hotspot.top < bottom and top < hotspot.bottom:
+				result.append(hotspot)
+
+		return result
+
+class RivenHotspotIndex:
+	def __init__(self, cards):
+		# cards: card ID -> list of RivenHotspot (without their scripts)
+		self._cards = cards
+		self._grids = {}
+		self._lock = threading.Lock()
+
+	def getCardIDs(self):
+		return sorted(self._cards)
+
+	def _getCard(self, cardID):
+		# Each card's grid is only built once it's asked about
+		with self._lock:
+			try:
+				return self._grids[cardID]
+			except KeyError:
+				card = RivenCardHotspots(self._cards.get(cardID, []))
+				self._grids[cardID] = card
+				return card
+
+	def getHotspots(self, cardID):
+		return list(self._cards.get(cardID, []))
+
+	def findHotspotsAt(self, cardID, x, y):
+		return self._getCard(cardID).findPoint(x, y)
+
+	def findHotspotsInRect(self, cardID, left, top, right, bottom):
+		return self._getCard(cardID).findRect(left, top, right, bottom)
+
+def buildRivenHotspotIndex(archive):
+	# Each card's hotspots share its ID
+	cards = {}
+
+	if 'HSPT' in archive.getTypes():
+		for resID in archive.getResourceList('HSPT'):
+			hotspots = parseRivenHotspots(ByteStream(archive.getResource('HSPT', resID)))
+
+			# Only the rects and the header are kept
+			for hotspot in hotspots:
+				hotspot.scripts = None
+
+			cards[resID] = hotspots
+
+	return RivenHotspotIndex(cards)
+
+def loadRivenHotspotIndex(cachePath, cacheKey):
+	# Returns None if the cache doesn't match the archive
+	if not os.path.exists(cachePath):
+		return None
+
+	with open(cachePath, 'rb') as f:
+		stream = ByteStream(bytearray(f.read()))
+
+	magic, version, size, mtime, pathLength = stream.readStruct(hotspotCacheHeader)
+	if magic != 'MHKH' or version != hotspotCacheVersion:
+		return None
+
+	absPath = str(stream.read(pathLength))
+	if (absPath, size, mtime) != cacheKey:
+		return None
+
+	cards = {}
+	cardCount = stream.readUint16BE()
+
+	for i in range(cardCount):
+		cardID = stream.readUint16BE()
+		hotspotCount = stream.readUint16BE()
+		hotspots = []
+
+		for index, left, top, right, bottom, blstID, nameID, cursor, zipModeHotspot in stream.readStructArray(hotspotCacheRecord, hotspotCount):
+			hotspots.append(RivenHotspot(blstID, nameID, left, top, right, bottom, cursor, index, zipModeHotspot, None))
+
+		cards[cardID] = hotspots
+
+	return RivenHotspotIndex(cards)
+
+def saveRivenHotspotIndex(cachePath, cacheKey, index):
+	absPath, size, mtime = cacheKey
+	output = ByteWriteStream()
+
+	output.write(hotspotCacheHeader.pack('MHKH', hotspotCacheVersion, size, mtime, len(absPath)))
+	output.write(absPath)
+
+	cardIDs = index.getCardIDs()
+	output.writeUint16BE(len(cardIDs))
+
+	for cardID in cardIDs:
+		hotspots = index.getHotspots(cardID)
+		output.writeUint16BE(cardID)
+		output.writeUint16BE(len(hotspots))
+
+		for hotspot in hotspots:
+			output.write(hotspotCacheRecord.pack(hotspot.index, hotspot.left, hotspot.top, hotspot.right, hotspot.bottom, hotspot.blstID, hotspot.nameID, hotspot.cursor, hotspot.zipModeHotspot))
+
+	writeCacheFile(cachePath, output.getData())
+
+# Hotspot indices for each open archive
+rivenHotspotIndices = weakref.WeakKeyDictionary()
+rivenHotspotIndicesLock = threading.Lock()
+
+def getRivenHotspotIndex(archive, indexCacheDir=None):
+	with rivenHotspotIndicesLock:
+		try:
+			return rivenHotspotIndices[archive]
+		except KeyError:
+			pass
+
+	# Single archives can keep the index next to their own index cache
+	cachePath = None
+	index = None
+
+	if indexCacheDir is not None and isinstance(archive, MohawkArchive):
+		cachePath = getIndexCachePath(indexCacheDir, archive.getPath(), '.hspt')
+		cacheKey = getIndexCacheKey(archive.getPath())
+
+		try:
+			index = loadRivenHotspotIndex(cachePath, cacheKey)
+		except Exception:
+			# Damaged; rebuild it below
+			index = None
+
+	if index is None:
+		index = buildRivenHotspotIndex(archive)
+
+		if cachePath is not None:
+			try:
+				saveRivenHotspotIndex(cachePath, cacheKey, index)
+			except Exception:
+				# The cache is only an optimization
+				pass
+
+	with rivenHotspotIndicesLock:
+		rivenHotspotIndices[archive] = index
+
+	return index
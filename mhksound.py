@@ -18,23 +18,10 @@
 # along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
 
 from stream import *
+import array
 import os
 import sys
 
-def decodeRaw(stream, bitsPerSample):
-	if bitsPerSample not in (8, 16):
-		raise Exception('Invalid bits per sample: {0}'.format(bitsPerSample))
-
-	samples = []
-
-	while stream.tell() < stream.size():
-		if bitsPerSample == 8:
-			samples.append(stream.readByte())
-		else:
-			samples.append(stream.readSint16LE())
-
-	return samples
-
 class ADPCMDecodeState:
 	def __init__(self):
 		self.last = 0
@@ -57,44 +44,99 @@ imaStepTable = [
 	15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767
 ]
 
-def decodeIMASample(data, state):
-	# Decode based on the current step
-	diff = (2 * (data & 0x07) + 1) * imaStepTable[state.stepIndex] // 8
-
-	# For the high bit, negate the sample
-	if (data & 0x08) != 0:
-		diff *= -1
-
-	# Apply the diff to the last sample, clipping it to 16-bit signed
-	sample = max(-32768, min(state.last + diff, 32767))
-
-	# Update the state
-	state.last = sample
-	state.stepIndex = max(0, min(state.stepIndex + imaIndexTable[data], len(imaStepTable) - 1))
-
-	return sample
-
-def decodeADPCM(stream, channels):
-	if channels not in (1, 2):
-		raise Exception('Invalid channel count: {0}'.format(channels))
-
-	samples = []
-	state = [ADPCMDecodeState(), ADPCMDecodeState()]
-
-	while stream.tell() < stream.size():
-		data = stream.readByte()
-		samples.append(decodeIMASample((data >> 4) & 0x0F, state[0]))
-		samples.append(decodeIMASample(data & 0x0F, state[0 if channels == 1 else 1]))
+def buildIMATables():
+	# Every step index and nibble pair, flattened as stepIndex * 16 + nibble,
+	# giving what the IMA ADPCM step would add to the last sample and the
+	# (pre-multiplied) step index it would move on to
+	deltas = []
+	nextIndexes = []
+
+	for stepIndex in range(len(imaStepTable)):
+		for data in range(16):
+			diff = (2 * (data & 0x07) + 1) * imaStepTable[stepIndex] // 8
+
+			if (data & 0x08) != 0:
+				diff *= -1
+
+			deltas.append(diff)
+			nextIndexes.append(max(0, min(stepIndex + imaIndexTable[data], len(imaStepTable) - 1)) * 16)
+
+	return deltas, nextIndexes
+
+imaDeltaTable, imaNextIndexTable = buildIMATables()
+
+def decodeADPCMData(data, channels, state):
+	# Decodes IMA ADPCM a nibble at a time, high nibble first, with the
+	# state held in locals and the maths done up front in the tables. The
+	# state is carried over to the next call.
+	deltas = imaDeltaTable
+	nextIndexes = imaNextIndexTable
+
+	samples = array.array('h', [0]) * (len(data) * 2)
+	pos = 0
+
+	last = state[0].last
+	index = state[0].stepIndex * 16
+
+	if channels == 1:
+		for value in data:
+			code = index + (value >> 4)
+			last += deltas[code]
+			if last > 32767:
+				last = 32767
+			elif last < -32768:
+				last = -32768
+			index = nextIndexes[code]
+			samples[pos] = last
+
+			code = index + (value & 0x0F)
+			last += deltas[code]
+			if last > 32767:
+				last = 32767
+			elif last < -32768:
+				last = -32768
+			index = nextIndexes[code]
+			samples[pos + 1] = last
+
+			pos += 2
+	else:
+		# The low nibble belongs to the right channel
+		lastRight = state[1].last
+		indexRight = state[1].stepIndex * 16
+
+		for value in data:
+			code = index + (value >> 4)
+			last += deltas[code]
+			if last > 32767:
+				last = 32767
+			elif last < -32768:
+				last = -32768
+			index = nextIndexes[code]
+			samples[pos] = last
+
+			code = indexRight + (value & 0x0F)
+			lastRight += deltas[code]
+			if lastRight > 32767:
+				lastRight = 32767
+			elif lastRight < -32768:
+				lastRight = -32768
+			indexRight = nextIndexes[code]
+			samples[pos + 1] = lastRight
+
+			pos += 2
+
+		state[1].last = lastRight
+		state[1].stepIndex = indexRight // 16
+
+	state[0].last = last
+	state[0].stepIndex = index // 16
 
 	return samples
 
-def writeWave(output, samples, channels, bitsPerSample, sampleRate):
+def writeWaveHeader(output, channels, bitsPerSample, sampleRate, dataSize):
 	if bitsPerSample not in (8, 16):
 		raise Exception('Unhandled wave bits per sample: {0}'.format(bitsPerSample))
 
-	# Calculate the data size
-	dataSize = len(samples) * bitsPerSample / 8
-
 	# Write the RIFF header
 	output.write('RIFF')
 	output.writeUint32LE(4 + (8 + 16) + (8 + dataSize)) # RIFF size
@@ -110,23 +152,34 @@ def writeWave(output, samples, channels, bitsPerSample, sampleRate):
 	output.writeUint16LE(channels * bitsPerSample / 8) # Block align
 	output.writeUint16LE(bitsPerSample)
 
-	# Write the data chunk
+	# Write the data chunk header; the samples follow
 	output.write('data')
-	output.writeUint32LE(len(samples) * bitsPerSample / 8) # data size
+	output.writeUint32LE(dataSize) # data size
 
-	# Encode all the samples
-	for sample in samples:
-		if bitsPerSample == 8:
-			output.writeByte(sample)
-		else:
-			output.writeSint16LE(sample)
+# How much audio data to handle at a time when converting
+audioChunkSize = 0x10000
 
-def convertMohawkWave(archive, resType, resID, options):
-	# Get the resource from the file
-	resource = archive.getResource(resType, resID)
+def copyAudioData(output, stream, size):
+	while size > 0:
+		data = stream.read(min(size, audioChunkSize))
+		output.write(data)
+		size -= len(data)
 
-	stream = ByteStream(resource)
+def writeADPCMWave(output, stream, size, channels, sampleRate):
+	# Every byte holds two samples, so the wave's size is known before
+	# anything gets decoded
+	writeWaveHeader(output, channels, 16, sampleRate, size * 4)
 
+	# Decode a chunk at a time, carrying the state across chunks, so that
+	# long sounds never need all their samples in memory
+	state = [ADPCMDecodeState(), ADPCMDecodeState()]
+
+	while size > 0:
+		data = stream.read(min(size, audioChunkSize))
+		output.writeArray(decodeADPCMData(data, channels, state), isLE=True)
+		size -= len(data)
+
+def readMohawkWaveHeader(stream):
 	mhkTag = stream.readUint32BE()
 	if mhkTag != makeTag('MHWK'):
 		raise Exception('Not a valid Mohawk sound file')
@@ -137,6 +190,9 @@ def convertMohawkWave(archive, resType, resID, options):
 	if mhkType != makeTag('WAVE'):
 		raise Exception('Not a Mohawk sound file')
 
+def readWaveDataChunk(stream):
+	# Find the next Data chunk and read its header, leaving the stream at
+	# the start of the audio data; None once there are no more
 	while stream.tell() < stream.size():
 		tag = stream.readUint32BE()
 		size = stream.readUint32BE()
@@ -146,42 +202,79 @@ def convertMohawkWave(archive, resType, resID, options):
 			stream.seek(size, os.SEEK_CUR)
 			continue
 
-		sampleRate = stream.readUint16BE()
-		stream.readUint32BE() # sample count
-		bitsPerSample = stream.readByte()
-		channels = stream.readByte()
-		encoding = stream.readUint16BE()
-		stream.readUint16BE() # loop count
-		stream.readUint32BE() # loop start
-		stream.readUint32BE() # loop end
-		audioData = ByteStream(stream.read(size - 20))
+		header = {}
+		header['chunkSize'] = size
+		header['sampleRate'] = stream.readUint16BE()
+		header['sampleCount'] = stream.readUint32BE()
+		header['bitsPerSample'] = stream.readByte()
+		header['channels'] = stream.readByte()
+		header['encoding'] = stream.readUint16BE()
+		header['loopCount'] = stream.readUint16BE()
+		header['loopStart'] = stream.readUint32BE()
+		header['loopEnd'] = stream.readUint32BE()
+
+		# Don't run past the end of the resource
+		header['dataSize'] = min(size - 20, stream.size() - stream.tell())
+
+		return header
+
+	return None
+
+def convertMohawkWave(archive, resType, resID, options):
+	# Get the resource from the file
+	resource = archive.getResource(resType, resID)
+
+	stream = ByteStream(resource)
+
+	readMohawkWaveHeader(stream)
+
+	while True:
+		header = readWaveDataChunk(stream)
+		if header is None:
+			break
+
+		sampleRate = header['sampleRate']
+		bitsPerSample = header['bitsPerSample']
+		channels = header['channels']
+		encoding = header['encoding']
+		dataStart = stream.tell()
+		dataSize = header['dataSize']
 
 		if encoding == 0:
-			# PCM
-			samples = decodeRaw(audioData, bitsPerSample)
+			# PCM, which is already laid out as a wave's samples are, so
+			# only the header needs writing
+			if bitsPerSample not in (8, 16):
+				raise Exception('Invalid bits per sample: {0}'.format(bitsPerSample))
+
+			if dataSize % (bitsPerSample // 8) != 0:
+				raise Exception('Incomplete sample at the end of the audio data')
 
 			output = open('{0}_{1}.wav'.format(resType, resID), 'wb')
 			with output:
 				outStream = FileWriteStream(output)
-				writeWave(outStream, samples, channels, bitsPerSample, sampleRate)
+				writeWaveHeader(outStream, channels, bitsPerSample, sampleRate, dataSize)
+				copyAudioData(outStream, stream, dataSize)
 		elif encoding == 1:
 			# ADPCM
-			samples = decodeADPCM(audioData, channels)
+			if channels not in (1, 2):
+				raise Exception('Invalid channel count: {0}'.format(channels))
 
 			output = open('{0}_{1}.wav'.format(resType, resID), 'wb')
 			with output:
 				outStream = FileWriteStream(output)
-				writeWave(outStream, samples, channels, 16, sampleRate)
+				writeADPCMWave(outStream, stream, dataSize, channels, sampleRate)
 		elif encoding == 2:
 			# MPEG Layer II
 			output = open('{0}_{1}.mp3'.format(resType, resID), 'wb')
 
 			with output:
-				output.write(audioData.read(audioData.size()))
+				copyAudioData(FileWriteStream(output), stream, dataSize)
 		else:
 			# Bad
 			raise Exception('Unknown tWAV encoding {0}'.format(encoding))
 
+		stream.seek(dataStart + header['chunkSize'] - 20)
+
 def convertMystSound(archive, resType, resID, options):
 	# Get the resource from the file
 	resource = archive.getResource(resType, resID)
@@ -272,3 +365,81 @@ def convertMohawkSound(archive, resType, resID, options):
 		convertMohawkWave(archive, resType, resID, options)
 	else:
 		raise Exception('Unknown Mohawk sound type: {0}'.format(mhkType))
+
+# Names for the Mohawk wave encodings
+waveEncodingNames = {
+	0: 'pcm',
+	1: 'adpcm',
+	2: 'mpeg2'
+}
+
+def probeMohawkWave(stream, record):
+	readMohawkWaveHeader(stream)
+
+	header = readWaveDataChunk(stream)
+	if header is None:
+		raise Exception('Mohawk sound has no Data chunk')
+
+	record['container'] = 'mohawk'
+	record['encoding'] = waveEncodingNames.get(header['encoding'], 'unknown')
+
+	for key in ('sampleRate', 'sampleCount', 'bitsPerSample', 'channels', 'loopCount', 'loopStart', 'loopEnd'):
+		record[key] = header[key]
+
+def probeRiffWave(stream, record):
+	record['container'] = 'riff'
+
+	# Skip the RIFF header
+	stream.seek(12)
+
+	blockAlign = None
+	dataSize = None
+
+	while stream.tell() + 8 <= stream.size():
+		tag = stream.read(4)
+		size = stream.readUint32LE()
+		start = stream.tell()
+
+		if tag == 'fmt ':
+			formatTag = stream.readUint16LE()
+			record['encoding'] = 'pcm' if formatTag == 1 else 'unknown'
+			record['channels'] = stream.readUint16LE()
+			record['sampleRate'] = stream.readUint32LE()
+			stream.readUint32LE() # Byte rate
+			blockAlign = stream.readUint16LE()
+			record['bitsPerSample'] = stream.readUint16LE()
+		elif tag == 'data':
+			dataSize = size
+
+		# Chunks are padded to an even size
+		stream.seek(start + size + (size & 1))
+
+	if blockAlign and dataSize is not None:
+		record['sampleCount'] = dataSize // blockAlign
+
+def probeSound(archive, resType, resID):
+	# Describe a sound from its headers alone, without decoding any samples
+	resource = archive.getResource(resType, resID)
+
+	stream = ByteStream(resource)
+
+	record = {'type': resType, 'id': resID}
+
+	tag = stream.read(4)
+	if tag == 'RIFF':
+		probeRiffWave(stream, record)
+	elif tag == 'MHWK':
+		stream.readUint32BE() # Skip size
+
+		mhkType = stream.read(4)
+		if mhkType == 'MIDI':
+			record['container'] = 'midi'
+		elif mhkType == 'WAVE':
+			stream.seek(0)
+			probeMohawkWave(stream, record)
+		else:
+			raise Exception('Unknown Mohawk sound type: {0}'.format(mhkType))
+	else:
+		raise Exception('Not a sound resource')
+
+	return record
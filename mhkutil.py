@@ -18,15 +18,17 @@
 # You should have received a copy of the GNU General Public License
 # along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import multiprocessing
 import optparse
 import sys
 
-from mhkarch import MohawkArchive
-from mhkbmp import convertMohawkBitmap, convertMystBitmap, convertMohawkBitmapSet
+from mhkarch import openArchive
+from mhkbmp import PaletteProvider, convertMohawkBitmap, convertMystBitmap, convertMohawkBitmapSet
 from mhkcursor import convertMacCursor
 from mhkmov import convertQuickTimeMovie
-from mhkriven import convertRivenCard, convertRivenHotspots, convertRivenNames
-from mhksound import convertMohawkWave, convertMohawkMIDI, convertMohawkSound, convertMystSound
+from mhkriven import convertRivenCard, convertRivenHotspots, convertRivenNames, buildRivenScriptIndex, loadRivenScriptIndex, getRivenHotspotIndex, getRivenNameTables
+from mhksound import convertMohawkWave, convertMohawkMIDI, convertMohawkSound, convertMystSound, probeSound
 from mhktext import convertStringList
 
 def dumpResource(archive, resType, resID, fileName=None):
@@ -99,7 +101,7 @@ def listResources(archive, resType, resID):
 
 def hexDumpResource(archive, resType, resID):
 	try:
-		resource = archive.getResource(resType, resID)
+		resource = bytearray(archive.getResource(resType, resID))
 	except Exception as ex:
 		sys.stderr.write('Failed to get resource {0} {1}: {2}\n'.format(resType, resID, ex))
 		sys.exit(1)
@@ -144,25 +146,267 @@ def convertResource(archive, resType, resID, options):
 		sys.stderr.write('Cannot convert resource type {0}\n'.format(resType))
 		sys.exit(1)
 
+	# Palettes are only shared for the length of this run
+	paletteProvider = PaletteProvider()
+	options = dict(options, paletteProvider=paletteProvider)
+
 	# Actually convert it
 	try:
 		convertFunc(archive, resType, resID, options)
 	except Exception as ex:
 		sys.stderr.write('Error converting resource: {0}\n'.format(ex))
 		sys.exit(1)
+	finally:
+		paletteProvider.close()
+
+# The archive and options each extract worker converts from
+extractArchive = None
+extractOptions = None
+
+def setExtractArchive(archive, options):
+	global extractArchive, extractOptions
+
+	extractArchive = archive
+
+	# Each worker keeps its own palettes for the whole run
+	extractOptions = dict(options, paletteProvider=PaletteProvider())
+
+def initExtractWorker(fileName, options):
+	# Open the archive once per worker, not once per resource
+	archive = openArchive(fileName, indexCacheDir=options['indexCache'], lazy=True, cacheSize=options['cacheSize'])
+	setExtractArchive(archive, options)
+
+def extractWorker(job):
+	# Returns the error text, or None on success
+	resType, resID = job
+
+	try:
+		convertTypes[resType](extractArchive, resType, resID, extractOptions)
+	except Exception as ex:
+		return resType, resID, str(ex)
+
+	return resType, resID, None
+
+def extractResources(archive, fileName, resTypes, resIDs, jobCount, options):
+	# Default to everything that can be converted
+	if resTypes is None:
+		resTypes = [type for type in archive.getTypes() if type in convertTypes]
+
+	jobs = []
+	missing = []
+
+	for type in sorted(resTypes):
+		if type not in convertTypes:
+			sys.stderr.write('Cannot convert resource type {0}\n'.format(type))
+			sys.exit(1)
+
+		if type not in archive.getTypes():
+			sys.stderr.write('No such resource type: {0}\n'.format(type))
+			sys.exit(1)
+
+		if resIDs:
+			idList = [id for id in resIDs if archive.hasResource(type, id)]
+			missing.extend((type, id) for id in resIDs if id not in idList)
+		else:
+			idList = sorted(archive.getResourceList(type))
+
+		jobs.extend((type, id) for id in idList)
+
+	# Report each failure, but keep going
+	failures = 0
+
+	for resType, resID in missing:
+		sys.stderr.write('Failed to convert {0} {1}: No such resource\n'.format(resType, resID))
+		failures += 1
+
+	if jobCount > 1:
+		pool = multiprocessing.Pool(jobCount, initExtractWorker, (fileName, options))
+		results = pool.imap_unordered(extractWorker, jobs)
+	else:
+		# Convert in this process, from the archive that's already open
+		pool = None
+		setExtractArchive(archive, options)
+		results = (extractWorker(job) for job in jobs)
+
+	for resType, resID, error in results:
+		if error is not None:
+			sys.stderr.write('Failed to convert {0} {1}: {2}\n'.format(resType, resID, error))
+			failures += 1
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+	else:
+		extractOptions['paletteProvider'].close()
+
+	total = len(jobs) + len(missing)
+	sys.stdout.write('Converted {0} of {1} resources\n'.format(total - failures, total))
+
+	if failures:
+		sys.exit(1)
+
+# Resource types that probe mode understands
+soundTypes = ['MSND', 'SND', 'tWAV']
+
+def probeSounds(archive, resTypes, resIDs):
+	# Default to every sound type present
+	if resTypes is None:
+		resTypes = [type for type in archive.getTypes() if type in soundTypes]
+
+	for type in sorted(resTypes):
+		if type not in soundTypes:
+			sys.stderr.write('Cannot probe resource type {0}\n'.format(type))
+			sys.exit(1)
+
+		if type not in archive.getTypes():
+			sys.stderr.write('No such resource type: {0}\n'.format(type))
+			sys.exit(1)
+
+		if resIDs:
+			idList = resIDs
+		else:
+			idList = sorted(archive.getResourceList(type))
+
+		# One JSON record per line, with any failure recorded in place
+		for id in idList:
+			if not archive.hasResource(type, id):
+				record = {'type': type, 'id': id, 'error': 'No such resource'}
+			else:
+				try:
+					record = probeSound(archive, type, id)
+				except Exception as ex:
+					record = {'type': type, 'id': id, 'error': str(ex)}
+
+			sys.stdout.write('{0}\n'.format(json.dumps(record, sort_keys=True)))
+
+def indexScripts(indexFile, paths, jobCount):
+	if not paths:
+		sys.stderr.write('Missing archive name\n')
+		sys.exit(1)
+
+	try:
+		index = buildRivenScriptIndex(paths, jobCount)
+	except Exception as ex:
+		sys.stderr.write('Failed to build the script index: {0}\n'.format(ex))
+		sys.exit(1)
+
+	# Report each failure, but keep what did work
+	for path, resType, resID, error in index.getErrors():
+		sys.stderr.write('Failed to index {0} {1} {2}: {3}\n'.format(path, resType, resID, error))
+
+	try:
+		index.save(indexFile)
+	except Exception as ex:
+		sys.stderr.write('Failed to write \'{0}\': {1}\n'.format(indexFile, ex))
+		sys.exit(1)
+
+	sys.stdout.write('Indexed {0} scripts from {1} archives\n'.format(len(index), len(index.getFiles())))
+
+# What query mode can search for
+queryKinds = ['command', 'opcode', 'read', 'stack', 'variable', 'write']
+
+def queryScripts(indexFile, terms):
+	# Terms come in pairs, all of which need to match
+	if not terms or len(terms) % 2 != 0:
+		sys.stderr.write('Query terms come in KIND NAME pairs\n')
+		sys.exit(1)
+
+	terms = zip(terms[0::2], terms[1::2])
+
+	for kind, name in terms:
+		if kind not in queryKinds:
+			sys.stderr.write('Unknown query kind \'{0}\'; expected one of {1}\n'.format(kind, ', '.join(queryKinds)))
+			sys.exit(1)
+
+	try:
+		index = loadRivenScriptIndex(indexFile)
+	except Exception as ex:
+		sys.stderr.write('Failed to open \'{0}\': {1}\n'.format(indexFile, ex))
+		sys.exit(1)
+
+	if index.isStale():
+		sys.stderr.write('Warning: the script index is out of date\n')
+
+	for path, resType, resID, hotspotIndex in index.query(terms):
+		desc = '{0} {1} {2}'.format(path, resType, resID)
+
+		if hotspotIndex is not None:
+			desc += ' hotspot {0}'.format(hotspotIndex)
+
+		sys.stdout.write('{0}\n'.format(desc))
+
+def findHotspots(archive, cardID, coords, indexCacheDir):
+	# Either a point or a rect
+	if len(coords) not in (2, 4):
+		sys.stderr.write('Expected X Y or LEFT TOP RIGHT BOTTOM\n')
+		sys.exit(1)
+
+	try:
+		index = getRivenHotspotIndex(archive, indexCacheDir)
+	except Exception as ex:
+		sys.stderr.write('Failed to index the hotspots: {0}\n'.format(ex))
+		sys.exit(1)
+
+	if len(coords) == 2:
+		hotspots = index.findHotspotsAt(cardID, *coords)
+	else:
+		hotspots = index.findHotspotsInRect(cardID, *coords)
+
+	for hotspot in hotspots:
+		desc = 'Hotspot {0}'.format(hotspot.index)
+
+		# See if there's a name
+		if hotspot.nameID != 0xFFFF:
+			try:
+				desc += ': ' + getRivenNameTables(archive).getHotspotNames()[hotspot.nameID]
+			except Exception:
+				pass
+
+		desc += ' ({0}, {1}, {2}, {3})'.format(hotspot.left, hotspot.top, hotspot.right, hotspot.bottom)
+		sys.stdout.write('{0}\n'.format(desc))
 
 def main():
 	# TODO: Probably some sort of output file name option
 	# TODO: Help text
-	parser = optparse.OptionParser()
+	parser = optparse.OptionParser(usage='%prog [options] MODE FILE [ARGS...]\n\n' +
+	                               'Coordinates given to hotspots mode may be negative; put them\n' +
+	                               'after -- so they are not taken for options:\n' +
+	                               '  %prog hotspots FILE CARD -- -10 -10 700 500')
 	parser.add_option('-p', '--palette', dest='palette',
 				      help='The palette ID to use if no palette is present ' +
 					       'in the converted image',
 					  metavar='ID', type='int')
 	parser.add_option('--palette-file', dest='paletteFile',
-	                  help='The archive from which to retrieve the palette. ' +
-	                       'The main archive is used if not specified.',
+	                  help='The archive (or directory of archives) from ' +
+	                       'which to retrieve the palette. The main archive ' +
+	                       'is used if not specified.',
 	                  metavar='FILE')
+	parser.add_option('--index-cache', dest='indexCache',
+	                  help='A directory in which to cache parsed archive ' +
+	                       'directories, speeding up repeated runs',
+	                  metavar='DIR')
+	parser.add_option('--cache-size', dest='cacheSize',
+	                  help='How many bytes of recently used resources to keep ' +
+	                       'in memory for each archive (none by default)',
+	                  metavar='BYTES', type='int', default=0)
+	parser.add_option('--png-profile', dest='pngProfile',
+	                  help='How hard to compress PNG images: none, fast, ' +
+	                       'balanced or max (the default)',
+	                  metavar='PROFILE', type='choice',
+	                  choices=['none', 'fast', 'balanced', 'max'], default='max')
+	parser.add_option('--image-format', dest='imageFormat',
+	                  help='The format to write images in: png (the ' +
+	                       'default), ppm, pgm (8-bit images only) or npy',
+	                  metavar='FORMAT', type='choice',
+	                  choices=['png', 'ppm', 'pgm', 'npy'], default='png')
+	parser.add_option('--script-format', dest='scriptFormat',
+	                  help='The format to write Riven scripts in: text ' +
+	                       '(the default) or json',
+	                  metavar='FORMAT', type='choice',
+	                  choices=['text', 'json'], default='text')
+	parser.add_option('-j', '--jobs', dest='jobs',
+	                  help='The number of processes to use in extract and index modes',
+	                  metavar='N', type='int', default=1)
 	options, args = parser.parse_args()
 
 	if len(args) < 1:
@@ -179,9 +423,22 @@ def main():
 	mode = args[0]
 	fileName = args[1]
 
+	# These work on a script index rather than a single archive
+	if mode == 'index':
+		indexScripts(fileName, args[2:], options.jobs)
+		return
+
+	if mode == 'query':
+		queryScripts(fileName, args[2:])
+		return
+
 	# Load the archive
+	# Listing and extracting need the whole directory up front; the
+	# other modes only touch the types they ask for
+	lazy = mode in ('dump', 'hexdump', 'convert')
+
 	try:
-		archive = MohawkArchive(fileName)
+		archive = openArchive(fileName, indexCacheDir=options.indexCache, lazy=lazy, cacheSize=options.cacheSize)
 	except Exception as ex:
 		sys.stderr.write('Failed to open \'{0}\': {1}\n'.format(fileName, ex))
 		sys.exit(1)
@@ -239,6 +496,31 @@ def main():
 
 		# Write the file
 		convertResource(archive, resType, resID, vars(options))
+	elif mode == 'extract':
+		# Optionally take a comma-separated list of types, then IDs
+		resTypes = None if len(args) < 3 else args[2].split(',')
+		resIDs = [int(arg) for arg in args[3:]]
+
+		# Convert everything that matches
+		extractResources(archive, fileName, resTypes, resIDs, options.jobs, vars(options))
+	elif mode == 'hotspots':
+		# Need a card, then a point or a rect
+		if len(args) < 3:
+			sys.stderr.write('Missing card ID\n')
+			sys.exit(1)
+
+		cardID = int(args[2])
+		coords = [int(arg) for arg in args[3:]]
+
+		# Print the hotspots found there
+		findHotspots(archive, cardID, coords, options.indexCache)
+	elif mode == 'probe':
+		# Optionally take a comma-separated list of types, then IDs
+		resTypes = None if len(args) < 3 else args[2].split(',')
+		resIDs = [int(arg) for arg in args[3:]]
+
+		# Print what's known about each sound
+		probeSounds(archive, resTypes, resIDs)
 	else:
 		sys.stderr.write('Unknown mode: \'{0}\'\n'.format(mode))
 		sys.exit(1)
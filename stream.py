@@ -17,8 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import mmap
 import os
 import struct
+import sys
+import threading
 
 # TODO: Find a better place for this
 def makeTag(text):
@@ -62,6 +66,48 @@ class Stream:
 	def readSint32BE(self):
 		return struct.unpack('>l', self.read(4))[0]
 
+	def readUint16BEArray(self, count):
+		return list(struct.unpack('>{0}H'.format(count), self.read(count * 2)))
+
+	def readUint32BEArray(self, count):
+		return list(struct.unpack('>{0}L'.format(count), self.read(count * 4)))
+
+	def readArray(self, typecode, count, isLE=False):
+		# Read count values straight into an array.array
+		values = array.array(typecode)
+		values.fromstring(bytes(self.read(values.itemsize * count)))
+
+		if (sys.byteorder == 'little') != isLE:
+			values.byteswap()
+
+		return values
+
+	def readStruct(self, record):
+		# record is either a struct.Struct or a format string
+		if not isinstance(record, struct.Struct):
+			record = struct.Struct(record)
+
+		return record.unpack(self.read(record.size))
+
+	def readStructArray(self, record, count):
+		# Decode count back-to-back records with a single unpack call,
+		# returning a list of tuples
+		if not isinstance(record, struct.Struct):
+			record = struct.Struct(record)
+
+		if count == 0:
+			return []
+
+		fieldCount = len(record.unpack(bytes(bytearray(record.size))))
+
+		# Repeat the record's fields, keeping the byte order prefix
+		format = record.format
+		byteOrder = format[0] if format[0] in '@=<>!' else ''
+		fields = format[len(byteOrder):]
+		values = struct.unpack(byteOrder + fields * count, self.read(record.size * count))
+
+		return list(zip(*[iter(values)] * fieldCount))
+
 	def readCString(self):
 		text = ''
 
@@ -105,12 +151,26 @@ class WriteStream:
 	def writeSint32BE(self, x):
 		self.write(struct.pack('>l', x))
 
+	def writeArray(self, values, isLE=False):
+		if (sys.byteorder == 'little') != isLE:
+			values = array.array(values.typecode, values)
+			values.byteswap()
+
+		self.write(values.tostring())
+
+	def writeUint32BEArray(self, x):
+		self.write(struct.pack('>{0}L'.format(len(x)), *x))
+
+# How much FileStream.copyAt copies at a time without sendfile
+copyChunkSize = 0x100000
+
 class FileStream(Stream):
 	def __init__(self, handle):
 		self._handle = handle
 		handle.seek(0, os.SEEK_END)
 		self._size = handle.tell()
 		handle.seek(0)
+		self._lock = threading.Lock()
 
 	def tell(self):
 		return self._handle.tell()
@@ -124,6 +184,118 @@ class FileStream(Stream):
 	def read(self, size):
 		return bytearray(self._handle.read(size))
 
+	def readAt(self, offset, size):
+		# Read without using (or disturbing) the current position, so
+		# that several threads can share the stream
+		if hasattr(os, 'pread'):
+			return bytearray(os.pread(self._handle.fileno(), size, offset))
+
+		# No pread (e.g. Python 2), so make the seek and read atomic instead
+		with self._lock:
+			oldPos = self._handle.tell()
+			self._handle.seek(offset)
+			data = self._handle.read(size)
+			self._handle.seek(oldPos)
+
+		return bytearray(data)
+
+	def copyAt(self, offset, size, output):
+		# Copy straight from this file to another open file, letting the
+		# kernel do it where possible
+		output.flush()
+
+		if hasattr(os, 'sendfile'):
+			try:
+				while size > 0:
+					copied = os.sendfile(output.fileno(), self._handle.fileno(), offset, size)
+					if copied == 0:
+						raise Exception('Unexpected end of file')
+
+					offset += copied
+					size -= copied
+			except OSError:
+				# Not supported for these files; copy the rest by hand
+				pass
+
+		while size > 0:
+			data = self.readAt(offset, min(size, copyChunkSize))
+			if not data:
+				raise Exception('Unexpected end of file')
+
+			output.write(data)
+			offset += len(data)
+			size -= len(data)
+
+	def close(self):
+		self._handle.close()
+
+class MappedFileStream(Stream):
+	def __init__(self, handle):
+		# The map keeps its own descriptor, so the handle isn't needed
+		# once the file is mapped
+		with handle:
+			self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+		self._size = len(self._map)
+		self._pos = 0
+
+		# Python 2's mmap only has the old buffer interface, so fall back
+		# to buffer() slices there. Either way, reads don't copy.
+		try:
+			self._view = memoryview(self._map)
+		except TypeError:
+			self._view = None
+
+	def tell(self):
+		return self._pos
+
+	def size(self):
+		return self._size
+
+	def seek(self, offset, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			self._pos += offset
+		elif whence == os.SEEK_END:
+			self._pos = self._size + offset
+		else:
+			self._pos = offset
+
+	def read(self, size):
+		data = self.readAt(self._pos, size)
+		self._pos = min(self._pos, self._size) + len(data)
+		return data
+
+	def readAt(self, offset, size):
+		# Slicing the map doesn't need the position, so this is safe to
+		# call from several threads at once
+		start = min(offset, self._size)
+		end = min(start + size, self._size)
+
+		if self._view is not None:
+			return self._view[start:end]
+
+		return buffer(self._map, start, end - start)
+
+	def copyAt(self, offset, size, output):
+		# The map has no descriptor to hand to sendfile, so write slices
+		# of it instead; these don't copy either
+		output.flush()
+
+		while size > 0:
+			data = self.readAt(offset, min(size, copyChunkSize))
+			if not data:
+				raise Exception('Unexpected end of file')
+
+			output.write(data)
+			offset += len(data)
+			size -= len(data)
+
+	def close(self):
+		# Views handed out by this stream stay valid, so the map (and its
+		# descriptor) only goes away once the last of them is released
+		self._map = None
+		self._view = None
+
 class FileWriteStream(WriteStream):
 	def __init__(self, handle):
 		self._handle = handle
@@ -131,6 +303,16 @@ class FileWriteStream(WriteStream):
 	def write(self, x):
 		self._handle.write(x)
 
+class ByteWriteStream(WriteStream):
+	def __init__(self):
+		self._data = bytearray()
+
+	def write(self, x):
+		self._data.extend(x)
+
+	def getData(self):
+		return self._data
+
 class ByteStream(Stream):
 	def __init__(self, data):
 		self._data = data
@@ -157,4 +339,19 @@ class ByteStream(Stream):
 		start = self._pos
 		end = start + size
 		self._pos = end
-		return self._data[start:end]
+		data = self._data[start:end]
+
+		# Views (such as those from MappedFileStream) get copied out here so
+		# that callers always get a mutable bytearray back
+		if not isinstance(data, bytearray):
+			data = bytearray(data)
+
+		return data
+
+	def readAt(self, offset, size):
+		data = self._data[offset:offset + size]
+
+		if not isinstance(data, bytearray):
+			data = bytearray(data)
+
+		return data
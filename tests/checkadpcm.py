@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# mhkutil - A utility for dealing with Mohawk archives
+#
+# mhkutil is the legal property of its developers, whose names
+# can be found in the AUTHORS file distributed with this source
+# distribution.
+#
+# mhkutil is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# mhkutil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
+
+# Checks the table driven IMA ADPCM decoder against a sample at a time
+# reference, then times both of them
+
+import os
+import random
+import sys
+import time
+
+# Use the modules one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mhksound import ADPCMDecodeState, decodeADPCMData, imaIndexTable, imaStepTable
+
+def decodeIMASample(data, state):
+	# The original decoder, one nibble at a time
+
+	# Decode based on the current step
+	diff = (2 * (data & 0x07) + 1) * imaStepTable[state.stepIndex] // 8
+
+	# For the high bit, negate the sample
+	if (data & 0x08) != 0:
+		diff *= -1
+
+	# Apply the diff to the last sample, clipping it to 16-bit signed
+	sample = max(-32768, min(state.last + diff, 32767))
+
+	# Update the state
+	state.last = sample
+	state.stepIndex = max(0, min(state.stepIndex + imaIndexTable[data], len(imaStepTable) - 1))
+
+	return sample
+
+def decodeReference(data, channels, state):
+	samples = []
+
+	for value in data:
+		samples.append(decodeIMASample((value >> 4) & 0x0F, state[0]))
+		samples.append(decodeIMASample(value & 0x0F, state[0 if channels == 1 else 1]))
+
+	return samples
+
+def newState():
+	return [ADPCMDecodeState(), ADPCMDecodeState()]
+
+def getStateValues(state):
+	return [(channel.last, channel.stepIndex) for channel in state]
+
+def makeRandomData(rand, size):
+	return bytearray(rand.randrange(256) for i in xrange(size))
+
+def makeClippingData(rand, size):
+	# Long runs of the largest nibbles drive the samples into both rails
+	data = bytearray()
+
+	while len(data) < size:
+		value = rand.choice([0x77, 0xFF, 0x7F, 0xF7])
+		data += bytearray([value]) * rand.randrange(1, 200)
+
+	return data[:size]
+
+def checkWhole(name, data, channels):
+	expected = decodeReference(data, channels, newState())
+	samples = decodeADPCMData(data, channels, newState())
+
+	if list(samples) != expected:
+		sys.stderr.write('{0}: samples differ\n'.format(name))
+		return False
+
+	return True
+
+def checkChunked(name, data, channels, rand):
+	# Decoding in pieces has to carry the state from one piece to the next
+	expectedState = newState()
+	expected = decodeReference(data, channels, expectedState)
+
+	state = newState()
+	samples = []
+	pos = 0
+
+	while pos < len(data):
+		size = rand.randrange(1, 5000)
+		samples.extend(decodeADPCMData(data[pos:pos + size], channels, state))
+		pos += size
+
+	if samples != expected:
+		sys.stderr.write('{0}: samples differ\n'.format(name))
+		return False
+
+	if getStateValues(state) != getStateValues(expectedState):
+		sys.stderr.write('{0}: final state differs\n'.format(name))
+		return False
+
+	return True
+
+def runChecks():
+	rand = random.Random(1)
+	success = True
+
+	for channels in (1, 2):
+		mode = 'mono' if channels == 1 else 'stereo'
+
+		for size in (0, 1, 2, 3, 1000, 65537):
+			data = makeRandomData(rand, size)
+			success &= checkWhole('{0} {1} bytes'.format(mode, size), data, channels)
+
+		# Make sure the clipping data really does reach both rails
+		data = makeClippingData(rand, 50000)
+		expected = decodeReference(data, channels, newState())
+		if 32767 not in expected or -32768 not in expected:
+			sys.stderr.write('{0} clipping: the data never clips\n'.format(mode))
+			success = False
+
+		success &= checkWhole('{0} clipping'.format(mode), data, channels)
+
+		for i in range(10):
+			data = makeRandomData(rand, rand.randrange(1, 40000))
+			success &= checkChunked('{0} chunked'.format(mode), data, channels, rand)
+
+		data = makeClippingData(rand, 40000)
+		success &= checkChunked('{0} chunked clipping'.format(mode), data, channels, rand)
+
+	return success
+
+def runBenchmark():
+	data = makeRandomData(random.Random(2), 500000)
+
+	for name, decodeFunc in (('reference', decodeReference), ('tables', decodeADPCMData)):
+		for channels in (1, 2):
+			start = time.time()
+			samples = decodeFunc(data, channels, newState())
+			elapsed = time.time() - start
+
+			sys.stdout.write('{0} {1}: {2:.0f} samples/sec\n'.format(name, 'mono' if channels == 1 else 'stereo', len(samples) / elapsed))
+
+def main():
+	if not runChecks():
+		sys.exit(1)
+
+	sys.stdout.write('All samples match\n')
+	runBenchmark()
+
+
+if __name__ == '__main__':
+	main()
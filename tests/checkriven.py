@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# mhkutil - A utility for dealing with Mohawk archives
+#
+# mhkutil is the legal property of its developers, whose names
+# can be found in the AUTHORS file distributed with this source
+# distribution.
+#
+# mhkutil is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# mhkutil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
+
+# Checks unpackRiven against the original, command at a time unpacker on
+# generated data, then times both of them on a full size Riven image
+
+import os
+import random
+import struct
+import sys
+import time
+
+# Use the modules one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mhkbmp import unpackRiven
+from stream import ByteStream
+
+# A full screen Riven image
+imageWidth = 608
+imageHeight = 392
+
+# The original unpacker, kept as the reference
+def unpackRivenReference(stream):
+	stream.readUint32BE() # Skip buffer size
+
+	output = bytearray()
+
+	subCommands = []
+
+	while stream.tell() < stream.size():
+		code = stream.readByte()
+
+		if code == 0x00:
+			# End of data
+			break
+		elif code in range(0x01, 0x40):
+			# Word Verbatim
+			output.extend(stream.read(code * 2))
+		elif code in range(0x40, 0x80):
+			# Word Repeat
+			data = output[-2:]
+
+			for i in range(code - 0x40):
+				output.extend(data)
+		elif code in range(0x80, 0xC0):
+			# Double Word Repeat
+			data = output[-4:]
+
+			for i in range(code - 0x80):
+				output.extend(data)
+		else:
+			# Specialized Commands
+			for i in range(code - 0xC0):
+				subCode = stream.readByte()
+
+				if subCode in range(0x01, 0x10):
+					output.append(output[-(subCode * 2)])
+					output.append(output[-(subCode * 2)])
+				elif subCode == 0x10:
+					output.append(output[-2])
+					output.append(stream.readByte())
+				elif subCode in range(0x11, 0x20):
+					output.append(output[-2])
+					output.append(output[-(subCode & 0x0F)])
+				elif subCode in range(0x20, 0x30):
+					output.append(output[-2])
+					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+				elif subCode in range(0x30, 0x40):
+					output.append(output[-2])
+					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+				elif subCode == 0x40:
+					output.append(stream.readByte())
+					output.append(output[-2])
+				elif subCode in range(0x41, 0x50):
+					output.append(output[-(subCode & 0x0F)])
+					output.append(output[-2])
+				elif subCode == 0x50:
+					output.extend(stream.read(2))
+				elif subCode in range(0x51, 0x58):
+					output.append(output[-(subCode & 0x07)])
+					output.append(stream.readByte())
+				elif subCode in range(0x59, 0x60):
+					output.append(stream.readByte())
+					output.append(output[-(subCode & 0x07)])
+				elif subCode in range(0x60, 0x70):
+					output.append(stream.readByte())
+					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+				elif subCode in range(0x70, 0x80):
+					output.append(stream.readByte())
+					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+				elif subCode in range(0x80, 0x90):
+					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+					output.append(output[-2])
+				elif subCode in range(0x90, 0xA0):
+					output.append((output[-2] + (subCode & 0x0F)) & 0xFF)
+					output.append(stream.readByte())
+				elif subCode == 0xA0:
+					pattern = stream.readByte()
+					output.append((output[-2] + (pattern >> 4)) & 0xFF)
+					output.append((output[-2] + (pattern & 0x0F)) & 0xFF)
+				elif subCode in range(0xA4, 0xA8):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(3):
+						output.append(output[-distance])
+
+					output.append(stream.readByte())
+				elif subCode in range(0xA8, 0xAC):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(4):
+						output.append(output[-distance])
+				elif subCode in range(0xAC, 0xB0):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(5):
+						output.append(output[-distance])
+
+					output.append(stream.readByte())
+				elif subCode == 0xB0:
+					pattern = stream.readByte()
+					output.append((output[-2] + (pattern >> 4)) & 0xFF)
+					output.append((output[-2] - (pattern & 0x0F)) & 0xFF)
+				elif subCode in range(0xB4, 0xB8):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(6):
+						output.append(output[-distance])
+				elif subCode in range(0xB8, 0xBC):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(7):
+						output.append(output[-distance])
+
+					output.append(stream.readByte())
+				elif subCode in range(0xBC, 0xC0):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(8):
+						output.append(output[-distance])
+				elif subCode in range(0xC0, 0xD0):
+					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+					output.append(output[-2])
+				elif subCode in range(0xD0, 0xE0):
+					output.append((output[-2] - (subCode & 0x0F)) & 0xFF)
+					output.append(stream.readByte())
+				elif subCode == 0xE0:
+					pattern = stream.readByte()
+					output.append((output[-2] - (pattern >> 4)) & 0xFF)
+					output.append((output[-2] + (pattern & 0x0F)) & 0xFF)
+				elif subCode in range(0xE4, 0xE8):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(9):
+						output.append(output[-distance])
+
+					output.append(stream.readByte())
+				elif subCode in range(0xE8, 0xEC):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(10):
+						output.append(output[-distance])
+				elif subCode in range(0xEC, 0xF0):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(11):
+						output.append(output[-distance])
+
+					output.append(stream.readByte())
+				elif subCode in (0xF0, 0xFF):
+					pattern = stream.readByte()
+					output.append((output[-2] - (pattern >> 4)) & 0xFF)
+					output.append((output[-2] - (pattern & 0x0F)) & 0xFF)
+				elif subCode in range(0xF4, 0xF8):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(12):
+						output.append(output[-distance])
+				elif subCode in range(0xF8, 0xFC):
+					distance = ((subCode & 0x03) << 8) | stream.readByte()
+
+					for j in range(13):
+						output.append(output[-distance])
+
+					output.append(stream.readByte())
+				elif subCode == 0xFC:
+					code1 = stream.readByte()
+					code2 = stream.readByte()
+					distance = ((code1 & 0x03) << 8) | code2
+					length = ((code1 >> 3) + 1) * 2 + 1
+
+					for j in range(length):
+						output.append(output[-distance])
+
+					if (code1 & (1 << 2)) == 0:
+						output.append(stream.readByte())
+					else:
+						output.append(output[-distance])
+				else:
+					raise Exception('Unknown Riven pack subcode 0x{0:02X}'.format(subCode))
+
+	return output
+
+# Sub-commands that copy from earlier output: how many bytes they write,
+# and whether the last one comes from the packed data instead
+rivenCopies = {
+	0xA4: (4, True),
+	0xA8: (4, False),
+	0xAC: (6, True),
+	0xB4: (6, False),
+	0xB8: (8, True),
+	0xBC: (8, False),
+	0xE4: (10, True),
+	0xE8: (10, False),
+	0xEC: (12, True),
+	0xF4: (12, False),
+	0xF8: (14, True)
+}
+
+# Sub-commands that neither unpacker knows
+rivenBadSubCommands = [0x00, 0x58, 0xA1, 0xA2, 0xA3, 0xB1, 0xB2, 0xB3, 0xE1, 0xE2, 0xE3, 0xF1, 0xF2, 0xF3, 0xFD, 0xFE]
+
+def getSubCommandDataSize(subCode):
+	# Packed bytes taken by the two byte sub-commands
+	if subCode == 0x50:
+		return 2
+	elif subCode in (0x10, 0x40, 0xA0, 0xB0, 0xE0, 0xF0, 0xFF):
+		return 1
+	elif 0x51 <= subCode <= 0x7F or 0x90 <= subCode <= 0x9F or 0xD0 <= subCode <= 0xDF:
+		return 1
+
+	return 0
+
+def packSubCommand(rand, packed, outputSize, wild):
+	# Returns how many bytes the sub-command writes. Wild data may use
+	# unknown sub-commands and reach back before the start of the output.
+	while True:
+		subCode = rand.randrange(0x100)
+		if wild or subCode not in rivenBadSubCommands:
+			break
+
+	packed.append(subCode)
+
+	maxDistance = 1023 if wild else min(outputSize, 1023)
+	distance = rand.randrange(1, max(2, maxDistance + 1))
+
+	if subCode == 0xFC:
+		code1 = (rand.randrange(32) << 3) | (rand.randrange(2) << 2) | (distance >> 8)
+		packed.extend([code1, distance & 0xFF])
+
+		if (code1 & 0x04) == 0:
+			packed.append(rand.randrange(0x100))
+
+		return ((code1 >> 3) + 1) * 2 + 2
+
+	if (subCode & 0xFC) in rivenCopies:
+		length, hasByte = rivenCopies[subCode & 0xFC]
+		packed[-1] = (subCode & 0xFC) | (distance >> 8)
+		packed.append(distance & 0xFF)
+
+		if hasByte:
+			packed.append(rand.randrange(0x100))
+
+		return length
+
+	for i in range(getSubCommandDataSize(subCode)):
+		packed.append(rand.randrange(0x100))
+
+	return 2
+
+def packRiven(rand, outputSize, wild=False):
+	# Random commands until there's at least outputSize bytes of output
+	packed = bytearray(struct.pack('>L', outputSize))
+
+	# Start with enough verbatim words for the sub-commands to look back on
+	count = rand.randrange(16, 40)
+	packed.append(count)
+	packed.extend(rand.randrange(0x100) for i in range(count * 2))
+	size = count * 2
+
+	while size < outputSize:
+		kind = rand.random()
+		count = rand.randrange(0, 0x40)
+
+		if kind < 0.2:
+			# Word Verbatim
+			count = max(count, 1)
+			packed.append(count)
+			packed.extend(rand.randrange(0x100) for i in range(count * 2))
+			size += count * 2
+		elif kind < 0.3:
+			# Word Repeat
+			packed.append(0x40 + count)
+			size += count * 2
+		elif kind < 0.4:
+			# Double Word Repeat
+			packed.append(0x80 + count)
+			size += count * 4
+		else:
+			# Specialized Commands
+			packed.append(0xC0 + count)
+
+			for i in range(count):
+				size += packSubCommand(rand, packed, size, wild)
+
+	# End of data, then some padding
+	packed.append(0x00)
+	packed.extend([0] * 5)
+
+	return packed
+
+def runUnpacker(unpackFunc, packed):
+	# Both unpackers have to fail on the same data, if not in the same way
+	try:
+		return str(unpackFunc(ByteStream(bytearray(packed))))
+	except Exception:
+		return None
+
+def runChecks():
+	rand = random.Random(1)
+	mismatches = 0
+	failures = 0
+	trials = 600
+
+	for trial in range(trials):
+		packed = packRiven(rand, rand.randrange(10, 3000), wild=trial % 3 == 0)
+		expected = runUnpacker(unpackRivenReference, packed)
+
+		if runUnpacker(unpackRiven, packed) != expected:
+			mismatches += 1
+
+		if expected is None:
+			failures += 1
+
+	sys.stdout.write('{0} of {1} trials differ ({2} expected failures)\n'.format(mismatches, trials, failures))
+	return mismatches == 0
+
+def runBenchmark():
+	packed = packRiven(random.Random(2), imageWidth * imageHeight)
+	results = []
+
+	for name, unpackFunc in (('reference', unpackRivenReference), ('unpackRiven', unpackRiven)):
+		start = time.time()
+		output = unpackFunc(ByteStream(bytearray(packed)))
+		elapsed = time.time() - start
+
+		results.append(str(output))
+		sys.stdout.write('{0}: {1:.3f}s for {2}x{3}\n'.format(name, elapsed, imageWidth, imageHeight))
+
+	if results[0] != results[1]:
+		sys.stderr.write('The unpacked images differ\n')
+		return False
+
+	sys.stdout.write('The unpacked images are identical\n')
+	return True
+
+def main():
+	success = runChecks()
+	success &= runBenchmark()
+
+	if not success:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
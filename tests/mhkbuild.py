@@ -0,0 +1,89 @@
+# mhkutil - A utility for dealing with Mohawk archives
+#
+# mhkutil is the legal property of its developers, whose names
+# can be found in the AUTHORS file distributed with this source
+# distribution.
+#
+# mhkutil is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# mhkutil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+
+def buildArchive(path, resources):
+	# Writes a Mohawk archive holding (type, id, name, data) resources,
+	# where the name may be None
+	types = {}
+	for resType, resID, name, data in resources:
+		types.setdefault(resType, []).append((resID, name, data))
+
+	typeList = sorted(types)
+
+	# The resource data follows the 28 byte header, in type order
+	fileTable = []
+	dataParts = []
+	offset = 28
+
+	for resType in typeList:
+		for resID, name, data in types[resType]:
+			fileTable.append((offset, len(data)))
+			dataParts.append(data)
+			offset += len(data)
+
+	absOffset = offset
+
+	# Then come the type table, each type's name and resource tables, the
+	# name strings and finally the file table
+	tableOffset = 4 + 8 * len(typeList)
+	tableParts = []
+	typeEntries = []
+	names = ''
+	fileIndex = 1
+
+	for resType in typeList:
+		nameEntries = []
+		resEntries = []
+
+		for resID, name, data in types[resType]:
+			if name is not None:
+				nameEntries.append(struct.pack('>HH', len(names), fileIndex))
+				names += name + '\0'
+
+			resEntries.append(struct.pack('>HH', resID, fileIndex))
+			fileIndex += 1
+
+		nameTable = struct.pack('>H', len(nameEntries)) + ''.join(nameEntries)
+		resTable = struct.pack('>H', len(resEntries)) + ''.join(resEntries)
+		typeEntries.append(struct.pack('>4sHH', resType.rjust(4, '\0'), tableOffset + len(nameTable), tableOffset))
+		tableParts.append(nameTable + resTable)
+		tableOffset += len(nameTable) + len(resTable)
+
+	nameOffset = tableOffset
+	fileTableOffset = nameOffset + len(names)
+
+	fileTableParts = [struct.pack('>L', len(fileTable))]
+	for offset, size in fileTable:
+		fileTableParts.append(struct.pack('>LHBBH', offset, size & 0xFFFF, (size >> 16) & 0xFF, (size >> 24) & 7, 0))
+
+	fileTableData = ''.join(fileTableParts)
+
+	typeTable = struct.pack('>HH', nameOffset, len(typeList)) + ''.join(typeEntries)
+	directory = typeTable + ''.join(tableParts) + names + fileTableData
+	fileSize = absOffset + len(directory)
+
+	header = 'MHWK' + struct.pack('>L', fileSize - 8) + 'RSRC'
+	header += struct.pack('>HHLLHH', 0x100, 0, fileSize, absOffset, fileTableOffset, len(fileTableData))
+
+	with open(path, 'wb') as output:
+		output.write(header)
+		output.write(''.join(dataParts))
+		output.write(directory)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# mhkutil - A utility for dealing with Mohawk archives
+#
+# mhkutil is the legal property of its developers, whose names
+# can be found in the AUTHORS file distributed with this source
+# distribution.
+#
+# mhkutil is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# mhkutil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mhkutil. If not, see <http://www.gnu.org/licenses/>.
+
+# Reads the same archives from many threads at once, while other threads
+# close and evict them, and checks every resource against a sequential read
+
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+
+# Use the modules one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mhkbuild import buildArchive
+from mhkarch import MohawkArchive, MohawkArchiveSet
+
+threadCount = 8
+readCount = 2000
+
+def buildArchives(directory, archiveCount):
+	rand = random.Random(1)
+	paths = []
+
+	for i in range(archiveCount):
+		# Give each archive its own IDs so that the set reads from all of them
+		resources = []
+		for resID in range(i * 100, i * 100 + 100):
+			size = rand.randrange(1, 0x4000)
+			data = ''.join(chr(rand.randrange(256)) for x in xrange(size))
+			resources.append(('tBMP', resID, None, data))
+
+		path = os.path.join(directory, 'stack{0}.mhk'.format(i))
+		buildArchive(path, resources)
+		paths.append(path)
+
+	return paths
+
+def readSequentially(archive):
+	expected = {}
+
+	for resType in archive.getTypes():
+		for resID in archive.getResourceList(resType):
+			expected[(resType, resID)] = str(archive.getResource(resType, resID))
+
+	return expected
+
+def countOpenFiles():
+	# Only Linux makes this easy; returns None elsewhere. Anything only
+	# waiting on the garbage collector doesn't count.
+	gc.collect()
+
+	try:
+		return len(os.listdir('/proc/self/fd'))
+	except OSError:
+		return None
+
+def checkOpenFiles(name, baseCount, maxOpen):
+	# Once nothing holds on to a resource, the set must be down to its
+	# limit of open files
+	count = countOpenFiles()
+	if count is None:
+		return True
+
+	sys.stdout.write('{0}: {1} files open\n'.format(name, count - baseCount))
+
+	if count - baseCount > maxOpen:
+		sys.stderr.write('{0}: more than {1} files open\n'.format(name, maxOpen))
+		return False
+
+	return True
+
+def runThreads(name, archive, expected, closeFunc=None):
+	keys = sorted(expected)
+	errors = []
+	done = threading.Event()
+
+	def read(seed):
+		rand = random.Random(seed)
+
+		for i in xrange(readCount):
+			key = rand.choice(keys)
+
+			try:
+				data = str(archive.getResource(*key))
+			except Exception as ex:
+				errors.append('{0} {1}: {2}'.format(key[0], key[1], ex))
+				continue
+
+			if data != expected[key]:
+				errors.append('{0} {1}: data mismatch'.format(*key))
+
+	def close():
+		while not done.is_set():
+			try:
+				closeFunc()
+			except Exception as ex:
+				errors.append('close: {0}'.format(ex))
+
+	readers = [threading.Thread(target=read, args=(seed,)) for seed in range(threadCount)]
+	threads = list(readers)
+
+	if closeFunc is not None:
+		threads.append(threading.Thread(target=close))
+
+	for thread in threads:
+		thread.start()
+
+	for thread in readers:
+		thread.join()
+
+	done.set()
+
+	for thread in threads:
+		thread.join()
+
+	# Only show the first few; they tend to repeat
+	for error in errors[:10]:
+		sys.stderr.write('{0}: {1}\n'.format(name, error))
+
+	sys.stdout.write('{0}: {1} errors\n'.format(name, len(errors)))
+	return not errors
+
+def main():
+	directory = tempfile.mkdtemp()
+	success = True
+
+	try:
+		paths = buildArchives(directory, 4)
+
+		for mapped in (True, False):
+			mode = 'mapped' if mapped else 'unmapped'
+			expected = readSequentially(MohawkArchive(paths[0], mapped=False))
+
+			archive = MohawkArchive(paths[0], mapped=mapped)
+			success &= runThreads('{0} reads'.format(mode), archive, expected)
+
+			archive = MohawkArchive(paths[0], mapped=mapped, cacheSize=0x40000)
+			success &= runThreads('{0} cached reads'.format(mode), archive, expected)
+
+			# Another thread keeps closing the file under the readers
+			archive = MohawkArchive(paths[0], mapped=mapped)
+			success &= runThreads('{0} reads with close'.format(mode), archive, expected, archive.close)
+
+			# With one file open at a time, nearly every read evicts an
+			# archive another thread may be reading from
+			referenceSet = MohawkArchiveSet(directory, mapped=False)
+			expected = readSequentially(referenceSet)
+			referenceSet.close()
+			archive = None
+
+			baseCount = countOpenFiles()
+			name = '{0} set reads with eviction'.format(mode)
+			archiveSet = MohawkArchiveSet(directory, maxOpen=1, mapped=mapped)
+			success &= runThreads(name, archiveSet, expected)
+			success &= checkOpenFiles(name, baseCount, 1)
+			archiveSet.close()
+	finally:
+		shutil.rmtree(directory)
+
+	if not success:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()